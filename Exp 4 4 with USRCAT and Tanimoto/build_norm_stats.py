@@ -0,0 +1,182 @@
+'''
+Build the normalization statistics (mean, std & quantiles) of the properties over a reference
+data set of SMILES (eg. ChemBL), used by 'fitness' to standardize properties.
+
+The data set is streamed through the worker pool in chunks, so memory use does not depend on
+its size, and progress is checkpointed after every chunk: an interrupted job resumes from the
+last completed chunk when run again with the same arguments.
+'''
+import os
+import json
+import time
+import multiprocessing
+import numpy as np
+
+import evolution_functions as evo
+import generation_props as gen_func
+import reference_set
+from property_cache import PropertyCache
+from property_registry import get_property_specs
+
+
+class RunningStats(object):
+    '''Online mean, variance (Welford/Chan update over chunks of values) and quantiles
+       (estimated from a uniform reservoir sample of bounded size) of a property.
+
+    Parameters:
+    reservoir_size (int) : Max. number of values kept for the quantile estimates
+    seed           (int) : Seed of the reservoir sampling
+    '''
+    def __init__(self, reservoir_size=100000, seed=0):
+        self.count          = 0
+        self.mean           = 0.0
+        self.m2             = 0.0      # sum of squared deviations from the mean
+        self.reservoir_size = reservoir_size
+        self.reservoir      = []
+        self.random_state   = np.random.RandomState(seed)
+
+    def update(self, values):
+        '''Add a chunk of values (NaN values are ignored)
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        chunk_mean  = values.mean()
+        chunk_m2    = ((values - chunk_mean)**2).sum()
+        total       = self.count + len(values)
+        delta       = chunk_mean - self.mean
+        self.mean  += delta * len(values) / total
+        self.m2    += chunk_m2 + delta**2 * self.count * len(values) / total
+        for value in values.tolist():
+            self.count += 1
+            if len(self.reservoir) < self.reservoir_size:
+                self.reservoir.append(value)
+            else:
+                idx = self.random_state.randint(0, self.count)
+                if idx < self.reservoir_size:
+                    self.reservoir[idx] = value
+
+    def std(self):
+        return float(np.sqrt(self.m2 / self.count)) if self.count > 0 else float('nan')
+
+    def summary(self, quantiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)):
+        '''Return the statistics as a dict (as stored in the stats file)
+        '''
+        summary = {'count': self.count, 'mean': self.mean, 'std': self.std()}
+        if len(self.reservoir) > 0:
+            summary['quantiles'] = {str(q): float(np.quantile(self.reservoir, q)) for q in quantiles}
+        return summary
+
+    def get_state(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'reservoir': self.reservoir,
+                'random_state': [item.tolist() if isinstance(item, np.ndarray) else item for item in self.random_state.get_state()]}
+
+    def set_state(self, state):
+        self.count     = state['count']
+        self.mean      = state['mean']
+        self.m2        = state['m2']
+        self.reservoir = list(state['reservoir'])
+        random_state   = list(state['random_state'])
+        random_state[1] = np.array(random_state[1], dtype=np.uint32)
+        self.random_state.set_state(tuple(random_state))
+
+
+def iter_smiles_chunks(filename, chunk_size, skip=0):
+    '''Yield (number of lines read, list of SMILES) for chunks of chunk_size lines of
+       filename, starting after the first skip lines. Empty lines are dropped.
+    '''
+    chunk     = []
+    num_lines = 0
+    with open(filename) as f:
+        for line in f:
+            num_lines += 1
+            if num_lines <= skip:
+                continue
+            chunk.append(line.strip())
+            if len(chunk) == chunk_size:
+                yield num_lines, [smi for smi in chunk if smi != '']
+                chunk = []
+    if len(chunk) > 0:
+        yield num_lines, [smi for smi in chunk if smi != '']
+
+
+def write_json(filename, content):
+    '''Write content to filename atomically (a partially written file is never left behind)
+    '''
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(content, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def build_norm_stats(smiles_file, stats_file, properties_calc_ls, starting_smile, num_processors,
+                     chunk_size=10000, checkpoint_file=None, usrcat_settings=None,
+                     reference_smile=reference_set.default_reference_smile, reference_dir=None):
+    '''Calculate properties_calc_ls for all molecules in smiles_file, and write their statistics
+       to stats_file (JSON, loaded with property_registry.load_norm_stats).
+
+    Molecules that cannot be parsed are skipped, as are molecules without a 3D embedding
+    for properties that need one (eg. USRSim).
+
+    Parameters:
+    smiles_file        (string) : Data set, one SMILE per line
+    stats_file         (string) : Output file
+    properties_calc_ls (list)   : Properties to be calculated (see property_registry.py)
+    starting_smile     (string) : Starting molecule of the GA (used by SIMILR)
+    num_processors     (int)    : Number of worker processes
+    chunk_size         (int)    : Number of lines processed (and checkpointed) at a time
+    checkpoint_file    (string) : Progress of the job (default: stats_file + '.checkpoint')
+    usrcat_settings, reference_smile, reference_dir : See generation_props.create_worker_pool
+    '''
+    if checkpoint_file is None:
+        checkpoint_file = stats_file + '.checkpoint'
+    properties_calc_ls = [spec.name for spec in get_property_specs(properties_calc_ls)]
+    properties_embed   = [spec.name for spec in get_property_specs(properties_calc_ls) if spec.cost == 'embedding']
+    job   = {'smiles_file': os.path.abspath(smiles_file), 'properties': properties_calc_ls, 'starting_smile': starting_smile,
+             'usrcat_settings': usrcat_settings, 'reference_smile': reference_smile}
+    stats = {name: RunningStats() for name in properties_calc_ls}
+    lines_done = 0
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if checkpoint['job'] != job:
+            raise Exception('Checkpoint ', checkpoint_file, ' belongs to a different job; remove it to start again')
+        lines_done = checkpoint['lines_done']
+        for name in properties_calc_ls:
+            stats[name].set_state(checkpoint['stats'][name])
+        print('Resuming after {} lines'.format(lines_done))
+
+    worker_pool = gen_func.create_worker_pool(num_processors, starting_smile, usrcat_settings, reference_smile, reference_dir)
+    try:
+        start_time = time.time()
+        for lines_done, chunk in iter_smiles_chunks(smiles_file, chunk_size, skip=lines_done):
+            chunk = list(set([smi_canon for mol, smi_canon, did_convert in map(evo.sanitize_smiles, chunk) if did_convert]))
+            property_cache = PropertyCache(max_size=0, max_failed=len(chunk))  # only records failed embeddings
+            results = gen_func.calculate_properties(worker_pool, chunk, properties_calc_ls, num_processors, property_cache)
+            for name in properties_calc_ls:
+                if name in properties_embed:
+                    stats[name].update([results[name][smi] for smi in chunk if not property_cache.is_failed(smi)])
+                else:
+                    stats[name].update([results[name][smi] for smi in chunk])
+            write_json(checkpoint_file, {'job': job, 'lines_done': lines_done,
+                                         'stats': {name: stats[name].get_state() for name in properties_calc_ls}})
+            print('{} lines done ({:.1f} mins)'.format(lines_done, (time.time() - start_time) / 60))
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+
+    write_json(stats_file, {'job': job, 'lines_done': lines_done,
+                            'properties': {name: stats[name].summary() for name in properties_calc_ls}})
+    return stats_file
+
+
+if __name__ == '__main__':
+    build_norm_stats(smiles_file        = './datasets/ChemBL_SMILES.txt',
+                     stats_file         = './datasets/ChemBL_norm_stats.json',
+                     properties_calc_ls = ['logP', 'SAS', 'RingP', 'USRSim', 'TaniSim'],                 # SIMILR is a constraint (not standardized)
+                     starting_smile     = 'CCO',                                                         # only used by SIMILR
+                     num_processors     = multiprocessing.cpu_count(),
+                     chunk_size         = 10000,                                                         # lines per chunk (& checkpoint)
+                     usrcat_settings    = {'num_confs': 1, 'fusion': 'max', 'seed': 0},                  # should match the settings of the GA runs
+                     reference_smile    = reference_set.default_reference_smile,
+                     reference_dir      = './datasets/reference')
@@ -2,6 +2,7 @@ import os
 from selfies import decoder 
 import time
 import multiprocessing
+import numpy as np
 import torch
 from tensorboardX import SummaryWriter
 from selfies import encoder
@@ -9,70 +10,126 @@ from selfies import encoder
 #### Directory Imports
 import discriminator as D
 import evolution_functions as evo
+import selfies_tokens
+import selection
+from novelty_filter import BloomFilter, get_novelty_settings
+from reference_index import ReferenceIndex
+from population_history import PopulationHistory
+from results_store import ResultsStore
 import generation_props as gen_func
+from property_cache import PropertyCache
+from property_registry import load_norm_stats, get_property_specs
+import reference_set
 
 
 
 def initiate_ga(num_generations,            generation_size,    starting_selfies,max_molecules_len,
                 disc_epochs_per_generation, disc_enc_type,      disc_layers,     training_start_gen,           
-                device,                     properties_calc_ls, num_processors,  beta, starting_smile, desired_delta, save_curve):
+                device,                     properties_calc_ls, num_processors,  beta, starting_smile, desired_delta, save_curve,
+                property_cache_size=50000,  usrcat_settings=None,  reference_smile=reference_set.default_reference_smile, reference_dir='./reference',
+                diagnostic_settings=None,   norm_stats_file=None,   pool_start_method=None, mutation_seed=None,
+                selection_settings=None,    novelty_settings=None,  reference_index_file=None,
+                history_file=None,          results_file=None):
     
        
     
     # Obtain starting molecule
     starting_smiles = evo.sanitize_multiple_smiles([decoder(selfie) for selfie in starting_selfies])
+    starting_tokens = [selfies_tokens.tokenize(selfie) for selfie in starting_selfies]   # the population is kept as SELFIE token ids
 
     
     # Recording Collective results
-    smiles_all         = []    # all SMILES seen in all generations
-    selfies_all        = []    # all SELFIES seen in all generation
+    history            = PopulationHistory(history_file)   # population of the live generation (earlier ones: archived in history_file)
     smiles_all_counter = {}    # 
+    property_cache     = PropertyCache(max_size=property_cache_size, max_failed=property_cache_size) # properties of molecules seen in this run
     
     
     # Initialize a Discriminator
     discriminator, d_optimizer, d_loss_func = D.obtain_initial_discriminator(disc_enc_type, disc_layers, max_molecules_len, device)
     
-    # Read in the Zinc data set 
-    molecules_reference = evo.read_dataset_encoding(disc_enc_type)
-#    print(molecules_reference[0:2])
-#    raise Exception()    
-    molecules_reference = dict.fromkeys(molecules_reference, '') # convert the zinc data set into a dictionary
+    # Hashed index of the ChemBL data set, built with reference_index.py (memory-mapped; None: not used)
+    molecules_reference = ReferenceIndex(reference_index_file) if reference_index_file is not None else None
+
+    # Standardization of properties, from a stats file built with build_norm_stats.py (None: built-in values)
+    if norm_stats_file is not None:
+        print('Normalization statistics loaded for: ', load_norm_stats(norm_stats_file))
+
+    # Worker processes for property calculations, kept alive for the entire run
+    # (the reference molecule(s) are embedded once, and stored in reference_dir)
+    worker_pool = gen_func.create_worker_pool(num_processors, starting_smile, usrcat_settings, reference_smile, reference_dir, pool_start_method)
+
+    # Results of all generations in a single database, written in the background (None: text files; see results_store.py)
+    # (created after the worker pool, so that its writer thread & connection are not forked into the workers)
+    results_store = ResultsStore(results_file, get_property_specs(properties_calc_ls)) if results_file is not None else None
+
+    # Seed of the selection & mutations (a new seed is drawn if mutation_seed is None; reuse it to repeat the run)
+    run_seed = np.random.SeedSequence(mutation_seed).entropy
+    print('Mutation seed: ', run_seed)
+
+    # All evaluated molecules, so that mutations do not go back to them (None: disabled; see novelty_filter.py)
+    if novelty_settings is not None:
+        novelty_settings = get_novelty_settings(novelty_settings)
+        novelty_filter   = BloomFilter(novelty_settings['capacity'], novelty_settings['error_rate'])
+    else:
+        novelty_filter   = None
 
     # Set up Generation Loop 
     total_time = time.time()
-    for generation_index in range(1, num_generations+1):
-        print("   ###   On generation %i of %i"%(generation_index, num_generations))
-        start_time = time.time()
+    try:
+        for generation_index in range(1, num_generations+1):
+            print("   ###   On generation %i of %i"%(generation_index, num_generations))
+            start_time = time.time()
 
               
-        # Obtain molecules from the previous generation 
-        smiles_here, selfies_here = gen_func.obtain_previous_gen_mol(starting_smiles,   starting_selfies, generation_size, 
-                                                                     generation_index,  selfies_all,      smiles_all)
-
-        # Calculate fitness of previous generation (shape: (generation_size, ))
-        fitness_here, order, fitness_ordered, smiles_ordered, selfies_ordered = gen_func.obtain_fitness(disc_enc_type,      smiles_here,   selfies_here, 
-                                                                                                        properties_calc_ls, discriminator, generation_index,
-                                                                                                        max_molecules_len,  device,        generation_size,  
-                                                                                                        num_processors,     writer,        beta,            image_dir, data_dir, starting_smile, desired_delta, save_curve)
-
-        # Obtain molecules that need to be replaced & kept
-        to_replace, to_keep = gen_func.apply_generation_cutoff(order, generation_size)
+            # Obtain molecules from the previous generation 
+            smiles_here, selfies_here = gen_func.obtain_previous_gen_mol(starting_smiles,   starting_tokens,  generation_size, 
+                                                                         generation_index,  history,          selection.get_rng(run_seed, generation_index, 'population'))
+
+            # Calculate fitness of previous generation (shape: (generation_size, ))
+            fitness_here, order, fitness_ordered, smiles_ordered, selfies_ordered = gen_func.obtain_fitness(disc_enc_type,      smiles_here,   selfies_here, 
+                                                                                                            properties_calc_ls, discriminator, generation_index,
+                                                                                                            max_molecules_len,  device,        generation_size,  
+                                                                                                            num_processors,     writer,        beta,            image_dir, data_dir, starting_smile, desired_delta, save_curve,
+                                                                                                            property_cache,     worker_pool,   diagnostic_settings, results_store,
+                                                                                                            selection.get_rng(run_seed, generation_index, 'diagnostics'))
+            if novelty_filter is not None:
+                novelty_filter.add(list(set(smiles_here)))
+            if molecules_reference is not None:
+                writer.add_scalar('novelty w.r.t. reference set', molecules_reference.novelty(smiles_here), generation_index)   # fraction of unique molecules not in ChemBL
+
+            # Obtain molecules that need to be replaced & kept
+            to_replace, to_keep = gen_func.apply_generation_cutoff(order, generation_size, fitness_ordered, selection_settings, 
+                                                                   selection.get_rng(run_seed, generation_index, 'selection'))
         
-        # Obtain new generation of molecules 
-        smiles_mutated, selfies_mutated = gen_func.obtain_next_gen_molecules(order,           to_replace,     to_keep, 
-                                                                             selfies_ordered, smiles_ordered, max_molecules_len)
-        for item in smiles_mutated:
-            mol, smi_canon, did_convert = evo.sanitize_smiles(item)
-            if did_convert == False:
-                raise Exception('Failed with (2): ', item)
+            # Obtain new generation of molecules 
+            smiles_mutated, selfies_mutated = gen_func.obtain_next_gen_molecules(order,           to_replace,     to_keep, 
+                                                                                 selfies_ordered, smiles_ordered, max_molecules_len,
+                                                                                 worker_pool,     num_processors, run_seed,         generation_index,
+                                                                                 novelty_filter,  novelty_settings['max_rerolls'] if novelty_filter is not None else 0)
+            for item in smiles_mutated:
+                mol, smi_canon, did_convert = evo.sanitize_smiles(item)
+                if did_convert == False:
+                    raise Exception('Failed with (2): ', item)
                 
-        # Record in collective list of molecules 
-        smiles_all, selfies_all, smiles_all_counter = gen_func.update_gen_res(smiles_all, smiles_mutated, selfies_all, selfies_mutated, smiles_all_counter)
-
-        print('Generation time: ', round((time.time()-start_time), 2), ' seconds')
+            # Record in collective list of molecules 
+            history, smiles_all_counter = gen_func.update_gen_res(history, generation_index+1, smiles_mutated, selfies_mutated, smiles_all_counter)
+
+            print('Generation time: ', round((time.time()-start_time), 2), ' seconds')
+    finally:
+        # Also if a generation fails: release the workers & shared memory, and keep the results recorded so far
+        worker_pool.close()
+        worker_pool.join()
+        if novelty_filter is not None:
+            novelty_filter.unlink()
+        try:
+            history.flush()
+        finally:
+            if results_store is not None:
+                results_store.close()
 
     print('Total time: ', round((time.time()-total_time)/60, 2), ' mins')
     print('Total number of unique molecules: ', len(smiles_all_counter))
+    print('Property cache hit rate: ', round(property_cache.hit_rate(), 3))
     return smiles_all_counter
 
 
@@ -115,7 +172,20 @@ if __name__ == '__main__':
                                                      beta                       = beta,
                                                      starting_smile             = smile,
                                                      desired_delta              = 0.4 ,
-                                                     save_curve                 = save_curve
+                                                     save_curve                 = save_curve,
+                                                     property_cache_size        = 50000,                                          # max. number of molecules with cached properties
+                                                     usrcat_settings            = {'num_confs': 1, 'fusion': 'max', 'seed': None}, # conformers per molecule, how their scores are combined & run seed (int: deterministic embedding; see usrcat.py)
+                                                     reference_smile            = reference_set.default_reference_smile,          # reference molecule for USRCAT & Tanimoto Similarity (or a list: panel of references)
+                                                     reference_dir              = '{}/reference'.format(data_dir),                # reference conformers are stored here
+                                                     diagnostic_settings        = {'mode': 'all', 'count': 100},                  # molecules that logP, SAS, RingP & TaniSim are calculated for: all/top_k/sample/off
+                                                     norm_stats_file            = None,                                           # stats file written by build_norm_stats.py (None: built-in zinc/ChemBL values)
+                                                     pool_start_method          = None,                                           # start method of the worker processes, eg. 'forkserver' (None: platform default)
+                                                     mutation_seed              = None,                                           # seed of the selection & mutations (int: same run for any number of processors)
+                                                     selection_settings         = {'scheme': 'fermi'},                            # molecules that survive a generation: fermi/truncation/tournament (see selection.py)
+                                                     novelty_settings           = {'capacity': 1000000, 'error_rate': 0.01},      # re-roll mutations into molecules evaluated before (None: disabled; see novelty_filter.py)
+                                                     reference_index_file       = None,                                           # hashed ChemBL data set, eg. './datasets/ChemBL_index.npy' as built by reference_index.py (None: not used)
+                                                     history_file               = '{}/population_history.jsonl.gz'.format(data_dir), # populations of all generations (read with population_history.iter_history)
+                                                     results_file               = '{}/results.db'.format(data_dir)                # SQLite results of the run (text files: results_store.export_text; None: write text files directly)
                                                 )   
         print('Total Experiment time: ', (time.time()-exper_time)/60, ' mins')
         
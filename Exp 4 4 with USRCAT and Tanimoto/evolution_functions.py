@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+import re
 import rdkit
 import shutil
 import multiprocessing
@@ -14,8 +15,8 @@ from selfies import decoder
 import numpy as np
 import inspect
 from collections import OrderedDict
-manager = multiprocessing.Manager()
-lock = multiprocessing.Lock()
+from shared_arrays import SharedArray, pack_strings, unpack_string
+import selfies_tokens
 
 
 def get_logP(mol):
@@ -40,16 +41,22 @@ def molecule_similarity(mol, target, radius=2, nBits=2048,
    :param target: rdkit mol object
    :return: float, [0.0, 1.0]
    """
-   x = rdMolDescriptors.GetMorganFingerprintAsBitVect(mol, radius=radius,
-                                                       nBits=nBits,
-                                                       useChirality=useChirality)
-   target = rdMolDescriptors.GetMorganFingerprintAsBitVect(target,
-                                                           radius=radius,
-                                                       nBits=nBits,
-                                                       useChirality=useChirality)
+   x = get_morgan_fingerprint(mol, radius=radius, nBits=nBits, useChirality=useChirality)
+   target = get_morgan_fingerprint(target, radius=radius, nBits=nBits, useChirality=useChirality)
    return DataStructs.TanimotoSimilarity(x, target)
 
 
+def get_morgan_fingerprint(mol, radius=2, nBits=2048, useChirality=True):
+   """
+   ECFP (Morgan) fingerprint of a molecule, as used by 'molecule_similarity'
+   :param mol: rdkit mol object
+   :return: ExplicitBitVect
+   """
+   return rdMolDescriptors.GetMorganFingerprintAsBitVect(mol, radius=radius,
+                                                         nBits=nBits,
+                                                         useChirality=useChirality)
+
+
     
 
 def make_clean_results_dir():
@@ -162,16 +169,17 @@ def read_dataset_encoding(disc_enc_type):
         return selfies_reference
     
     
-def create_100_mol_image(mol_list, file_name, fitness, logP, SAS, RingCount, USRSim, TaniSim):       #!#
+def create_100_mol_image(mol_list, file_name, fitness, properties=None):
     '''Create a single picture of multiple molecules in a single Grid.
+       Molecules are labelled with their fitness and properties (list of lists of values), if given
     '''
     assert len(mol_list) == 100
-    if logP == None and SAS == None and RingCount == None:
+    if properties == None:
         Draw.MolsToGridImage(mol_list, molsPerRow=10, subImgSize=(200,200)).save(file_name)
         return
 
     for i,m in enumerate(mol_list):
-        m.SetProp('_Name','%s %s %s %s %s, %s' % (round(fitness[i], 3), round(logP[i], 3), round(SAS[i], 3), round(RingCount[i], 3), round(USRSim[i], 3), round(TaniSim[i], 3))) 
+        m.SetProp('_Name',' '.join(['%s' % round(fitness[i], 3)] + ['%s' % round(values[i], 3) for values in properties])) 
     try:
         Draw.MolsToGridImage(mol_list, molsPerRow=10, subImgSize=(250,250), legends=[x.GetProp("_Name") for x in mol_list]).save(file_name)
     except:
@@ -194,11 +202,7 @@ def get_selfie_chars(selfie):
     Returns:
     chars_selfie: list of selfie characters present in molecule selfie
     '''
-    chars_selfie = [] # A list of all SELFIE sybols from string selfie
-    while selfie != '':
-        chars_selfie.append(selfie[selfie.find('['): selfie.find(']')+1])
-        selfie = selfie[selfie.find(']')+1:]
-    return chars_selfie
+    return selfies_tokens.get_selfie_chars(selfie)
 
 
 def smiles_alphabet(disc_enc_type):
@@ -233,6 +237,81 @@ def smiles_alphabet(disc_enc_type):
     return alphabet
 
 
+# Tokenizers of the one-hot encoding: 'Cl' & 'Br' are single SMILES characters, SELFIES characters are bracketed
+_token_patterns = {'smiles': re.compile(r'Cl|Br|.'), 'selfies': re.compile(r'\[[^\]]*\]')}
+
+# {disc_enc_type: {character: column of the one-hot encoding}}, built once per process
+_onehot_vocabs = {}
+
+
+def get_onehot_vocab(disc_enc_type):
+    '''Return {character: column} of the one-hot encoding, for the alphabet of 'smiles_alphabet'.
+       As in the original encoding, 'Cl' & 'Br' are the last two SMILES columns.
+    '''
+    if disc_enc_type not in _onehot_vocabs:
+        alphabet = smiles_alphabet(disc_enc_type)
+        if disc_enc_type == 'smiles':
+            alphabet.remove('Cl')
+            alphabet.remove('Br')
+            alphabet += ['Cl', 'Br']
+        _onehot_vocabs[disc_enc_type] = {char: idx for idx, char in enumerate(alphabet)}
+    return _onehot_vocabs[disc_enc_type]
+
+
+def onehot_indices(molecule_strs, disc_enc_type, max_molecules_len):
+    '''Convert molecule strings into columns of the one-hot encoding (see 'get_onehot_vocab'), 
+       padded with character 'X' to length max_molecules_len.
+    
+    Parameters:
+    molecule_strs     (list)  : SMILE/SELFIE strings of molecules 
+    disc_enc_type     (string): 'smiles' or 'selfies'
+    max_molecules_len (int)   : Length of the encoding 
+    
+    Returns:
+    indices (np.array) : uint8, shape (len(molecule_strs), max_molecules_len)
+    '''
+    vocab    = get_onehot_vocab(disc_enc_type)
+    tokenize = _token_patterns[disc_enc_type].findall
+    tokens   = [tokenize(molecule) for molecule in molecule_strs]
+    lengths  = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+    if len(tokens) > 0 and lengths.max() > max_molecules_len:
+        raise Exception('Molecule is too large! ', molecule_strs[int(np.argmax(lengths > max_molecules_len))])
+
+    columns = np.fromiter((vocab.get(char, -1) for molecule in tokens for char in molecule), dtype=np.int16, count=int(lengths.sum()))
+    if np.any(columns < 0):
+        position = int(np.argmax(columns < 0))
+        row      = int(np.searchsorted(np.cumsum(lengths), position, side='right'))
+        raise Exception('Character not in alphabet: ', [char for char in tokens[row] if char not in vocab], ' MOLECULE: ', molecule_strs[row])
+
+    indices   = np.full((len(molecule_strs), max_molecules_len), vocab['X'], dtype=np.uint8)
+    rows      = np.repeat(np.arange(len(molecule_strs)), lengths)
+    positions = np.arange(len(columns)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    indices[rows, positions] = columns
+    return indices
+
+
+def onehot_encode(molecule_strs, disc_enc_type, max_molecules_len, return_indices=False, dtype=np.uint8):
+    '''One-hot encoding of a batch of molecule strings (see 'onehot_indices')
+    
+    Parameters:
+    molecule_strs     (list)  : SMILE/SELFIE strings of molecules 
+    disc_enc_type     (string): 'smiles' or 'selfies'
+    max_molecules_len (int)   : Length of the encoding 
+    return_indices    (bool)  : Also return the column indices (eg. for embedding layers)
+    dtype             (type)  : np.uint8 or bool
+    
+    Returns:
+    one_hots (np.array) : shape (len(molecule_strs), max_molecules_len, len(alphabet))
+    indices  (np.array) : uint8, shape (len(molecule_strs), max_molecules_len) (if return_indices)
+    '''
+    indices  = onehot_indices(molecule_strs, disc_enc_type, max_molecules_len)
+    one_hots = np.zeros(indices.shape + (len(get_onehot_vocab(disc_enc_type)), ), dtype=dtype)
+    one_hots[np.arange(indices.shape[0])[:, None], np.arange(indices.shape[1])[None, :], indices] = 1
+    if return_indices:
+        return one_hots, indices
+    return one_hots
+
+
 def _to_onehot(molecule_str, disc_enc_type, max_molecules_len):
     '''Convert given molecule string into a one-hot encoding, with characters 
        obtained from function 'smiles_alphabet'.
@@ -241,56 +320,24 @@ def _to_onehot(molecule_str, disc_enc_type, max_molecules_len):
     'max_molecules_len' by padding with character 'X'
        
     Parameters:
-    molecule_str      (string): SMILE/SELFIE string of molecule 
+    molecule_str      (list)  : SMILE/SELFIE strings of molecules 
     disc_enc_type     (string): Indicating weather molecule string is either
                                 SMILE or SELFIE 
     max_molecules_len (string): Length of the one-hot encoding 
     
     Returns:
-    one_hots   (list of lists): One-Hot encoding of molecule string, padding 
-                                till length max_molecules_len (dim: len(alphabet) * max_molecules_len)
+    one_hots   (np.array): One-Hot encoding of molecule strings (uint8), padding 
+                           till length max_molecules_len (dim: len(molecule_str), len(alphabet) * max_molecules_len)
     '''
-    one_hots=[]
-    alphabet = smiles_alphabet(disc_enc_type)
-    alphabet_length = len(alphabet)
+    return onehot_encode(molecule_str, disc_enc_type, max_molecules_len).reshape((len(molecule_str), -1))
 
-    if disc_enc_type == 'smiles': 
-        alphabet.remove('Cl')      # Replace 'Cl' & 'Br' with 'Y' & 'Z' for convenience
-        alphabet.remove('Br')      # (Searching for single characters is easier)
-        alphabet.append('Y')
-        alphabet.append('Z')
-    
-    for smi in molecule_str:
-        # Relace 'Cl' and 'Br' with 'Y', 'Z' from smi (for conveninece)
-        if disc_enc_type == 'smiles':
-            smi = smi.replace('Cl', 'Y')
-            smi = smi.replace('Br', 'Z')
-            
-        one_hot=[]
-        
-        if disc_enc_type == 'selfies':
-            smi = get_selfie_chars(smi)
-        if len(smi) > max_molecules_len:
-            exit("Molecule is too large!")
-        for char in smi:
-            if char not in alphabet:
-                print("smiles character %s not in alphabet MOLECULE: %s"%(char, smi))
-            zeros = np.zeros((alphabet_length)).astype(np.int32).tolist()
-            zeros[alphabet.index(char)] = 1
-            one_hot+=zeros
-            
-        # Padding with 'X's
-        for char in range(max_molecules_len-len(smi)):
-            zeros = np.zeros((alphabet_length)).astype(np.int32).tolist()
-            zeros[alphabet.index("X")] = 1
-            one_hot += zeros
-        one_hots.append(one_hot)
-    one_hots = np.array(one_hots)
-    return (one_hots)
 
+# SELFIE characters inserted by 'mutate_tokens' (the last one adds a benzene ring)
+mutation_alphabet = ['[Branch1_1]', '[Branch1_2]','[Branch1_3]', '[epsilon]', '[Ring1]', '[Ring2]', '[Branch2_1]', '[Branch2_2]', '[Branch2_3]', '[F]', '[O]', '[=O]', '[N]', '[=N]', '[#N]', '[C]', '[=C]', '[#C]', '[S]', '[=S]', '[C][=C][C][=C][C][=C][Ring1][Branch1_1]']
 
-def mutations_random_grin(selfie, max_molecules_len, write_fail_cases=False):
-    '''Return a mutated selfie string
+
+def mutate_tokens(tokens, max_molecules_len, write_fail_cases=False, rng=None, seen=None, max_rerolls=10):
+    '''Return a mutation of a SELFIE in token ids (see selfies_tokens.py)
     
     Mutations are done until a valid molecule is obtained 
     Rules of mutation: With a 50% propbabily, either: 
@@ -298,46 +345,51 @@ def mutations_random_grin(selfie, max_molecules_len, write_fail_cases=False):
         2. Replace a random SELFIE character with another
     
     Parameters:
-    selfie            (string)  : SELFIE string to be mutated 
+    tokens            (bytes)   : Token ids of the SELFIE to be mutated 
     max_molecules_len (int)     : Mutations of SELFIE string are allowed up to this length
     write_fail_cases  (bool)    : If true, failed mutations are recorded in "selfie_failure_cases.txt"
+    rng  (np.random.Generator)  : Random numbers of the mutation (None: the global np.random state)
+    seen              (object)  : Canonical smiles that are not wanted as mutation (eg. novelty_filter.BloomFilter);
+                                  a mutation in seen is re-rolled, at most max_rerolls times
+    max_rerolls       (int)     : See seen
     
     Returns:
-    selfie_mutated    (string)  : Mutated SELFIE string
-    smiles_canon      (string)  : canonical smile of mutated SELFIE string
+    tokens_mutated    (bytes)   : Token ids of the mutated SELFIE
+    smiles_canon      (string)  : canonical smile of mutated SELFIE
     '''
     valid=False
     fail_counter = 0
-    chars_selfie = get_selfie_chars(selfie)
+    num_rerolls  = 0
+    alphabet = [selfies_tokens.tokenize(char) for char in mutation_alphabet]
+    if rng is None:
+        uniform, integers = np.random.random, np.random.randint
+    else:
+        uniform, integers = rng.random, rng.integers
     
     while not valid:
         fail_counter += 1
-                
-        alphabet = ['[Branch1_1]', '[Branch1_2]','[Branch1_3]', '[epsilon]', '[Ring1]', '[Ring2]', '[Branch2_1]', '[Branch2_2]', '[Branch2_3]', '[F]', '[O]', '[=O]', '[N]', '[=N]', '[#N]', '[C]', '[=C]', '[#C]', '[S]', '[=S]', '[C][=C][C][=C][C][=C][Ring1][Branch1_1]']
 
         # Insert a character in a Random Location
-        if np.random.random() < 0.5: 
-            random_index = np.random.randint(len(chars_selfie)+1)
-            random_character = np.random.choice(alphabet, size=1)[0]
-            selfie_mutated_chars = chars_selfie[:random_index] + [random_character] + chars_selfie[random_index:]
+        if uniform() < 0.5: 
+            random_index = integers(len(tokens)+1)
+            random_character = alphabet[integers(len(alphabet))]
+            tokens_mutated = tokens[:random_index] + random_character + tokens[random_index:]
 
         # Replace a random character 
         else:                         
-            random_index = np.random.randint(len(chars_selfie))
-            random_character = np.random.choice(alphabet, size=1)[0]
-            if random_index==0:
-                selfie_mutated_chars = [random_character] + chars_selfie[random_index+1:]
-            else:
-                selfie_mutated_chars = chars_selfie[:random_index] + [random_character] + chars_selfie[random_index+1:]
+            random_index = integers(len(tokens))
+            random_character = alphabet[integers(len(alphabet))]
+            tokens_mutated = tokens[:random_index] + random_character + tokens[random_index+1:]
 
-                
-        selfie_mutated = "".join(x for x in selfie_mutated_chars)
-        sf = "".join(x for x in chars_selfie)
+        selfie_mutated = selfies_tokens.detokenize(tokens_mutated)
         try:
             smiles = decoder(selfie_mutated)
             mol, smiles_canon, done = sanitize_smiles(smiles)
             if len(smiles_canon) > max_molecules_len or smiles_canon=="":
                 done=False
+            if done and seen is not None and num_rerolls < max_rerolls and smiles_canon in seen:
+                num_rerolls += 1
+                done=False
             if done:
                 valid=True
             else:
@@ -346,9 +398,46 @@ def mutations_random_grin(selfie, max_molecules_len, write_fail_cases=False):
             valid=False
             if fail_counter > 1 and write_fail_cases == True:
                 f = open("selfie_failure_cases.txt", "a+")
-                f.write('Tried to mutate SELFIE: '+str(sf)+' To Obtain: '+str(selfie_mutated) + '\n')
+                f.write('Tried to mutate SELFIE: '+selfies_tokens.detokenize(tokens)+' To Obtain: '+str(selfie_mutated) + '\n')
                 f.close()
-    return (selfie_mutated, smiles_canon)
+    return (tokens_mutated, smiles_canon)
+
+
+def mutations_random_grin(selfie, max_molecules_len, write_fail_cases=False):
+    '''Return a mutated selfie string (see 'mutate_tokens')
+    
+    Parameters:
+    selfie            (string)  : SELFIE string to be mutated 
+    max_molecules_len (int)     : Mutations of SELFIE string are allowed up to this length
+    write_fail_cases  (bool)    : If true, failed mutations are recorded in "selfie_failure_cases.txt"
+    
+    Returns:
+    selfie_mutated    (string)  : Mutated SELFIE string
+    smiles_canon      (string)  : canonical smile of mutated SELFIE string
+    '''
+    tokens_mutated, smiles_canon = mutate_tokens(selfies_tokens.tokenize(selfie), max_molecules_len, write_fail_cases)
+    return (selfies_tokens.detokenize(tokens_mutated), smiles_canon)
+
+
+# SMARTS patterns used by 'get_mol_info', compiled once per process (see 'get_smarts')
+_smarts_patterns = {}
+
+
+def get_smarts(smarts):
+    '''Return the compiled pattern of SMARTS string smarts (compiled on first use, then reused)
+    '''
+    pattern = _smarts_patterns.get(smarts)
+    if pattern is None:
+        pattern = _smarts_patterns[smarts] = Chem.MolFromSmarts(smarts)
+    return pattern
+
+
+def preload_smarts():
+    '''Compile all SMARTS patterns used by 'get_mol_info'
+    '''
+    for atomic_num in [6, 7, 8, 9, 16, 17, 35]:
+        get_smarts("[#{}]".format(atomic_num))
+    get_smarts('*-&!@*')
 
 
 def count_atoms(mol, atomic_num):
@@ -361,7 +450,7 @@ def count_atoms(mol, atomic_num):
     Returns:
     (int) :  final count of atom
     '''
-    pat = Chem.MolFromSmarts("[#{}]".format(atomic_num))
+    pat = get_smarts("[#{}]".format(atomic_num))
     return len(mol.GetSubstructMatches(pat))
 
 
@@ -438,7 +527,7 @@ def get_rot_bonds_posn(mol):
     >>> get_rot_bonds_posn('CCC1=CC=CC=C1') # (Rotatable Bonds At: CH3, CH3 & Benzene)
     ((0, 1), (1, 2))
     '''
-    RotatableBond = Chem.MolFromSmarts('*-&!@*')
+    RotatableBond = get_smarts('*-&!@*')
     rot = mol.GetSubstructMatches(RotatableBond)
     return rot
 
@@ -522,79 +611,151 @@ def size_ring_counter(ring_ls):
             
 
 
-def get_mol_info(smi):                 
-    ''' Calculate a set of 51 RdKit properties, collected from above helper functions. 
-    
-    Parameters:
-    smi (string) : SMILE string of molecule 
-    
+# RdKit descriptors included in the properties of 'get_mol_info'
+mol_info_descriptors = ["RingCount", "HallKierAlpha", "BalabanJ", "NumAliphaticCarbocycles","NumAliphaticHeterocycles",
+                        "NumAliphaticRings","NumAromaticCarbocycles","NumAromaticHeterocycles",
+                        "NumAromaticRings","NumHAcceptors","NumHDonors","NumHeteroatoms",
+                        "NumRadicalElectrons","NumSaturatedCarbocycles","NumSaturatedHeterocycles",
+                        "NumSaturatedRings","NumValenceElectrons"]
+mol_info_size        = 51   # number of properties calculated by 'get_mol_info'
+_descriptor_functions = []
+
+
+def get_descriptor_functions():
+    '''Return the RdKit descriptor functions in 'mol_info_descriptors', in the order in which they
+       appear in the properties of 'get_mol_info' (sorted by name). Resolved once per process.
+    '''
+    if len(_descriptor_functions) == 0:
+        calc_props = OrderedDict(inspect.getmembers(Descriptors, inspect.isfunction))
+        for key, val in calc_props.items():
+            if not key.startswith('_') and key in mol_info_descriptors:
+                _descriptor_functions.append(val)
+    return _descriptor_functions
+
+
+def ring_statistics(mol, smi):
+    '''Ring statistics of 'get_mol_info': the number of ring fragments of mol (ie. what is left of the
+       ring systems after cutting all rotatable bonds, see 'obtain_rings'), the number of triple bonds 
+       in them, and the 19 features of 'size_ring_counter'.
+
+    The fragments are obtained directly from the molecular graph (connected components over the
+    bonds that are not rotatable). Molecules for which this could differ from parsing the fragment 
+    SMILES (explicit hydrogens, isotopes or atom maps, and fragments with 2 or more double bonds,
+    which may be consecutive) go through 'obtain_rings' & 'size_ring_counter'.
+
     Returns:
-    (list of float) : list of 51 calculated properties  
+    (list) : [num. ring fragments, num. triple bonds in ring fragments] + 19 features of 'size_ring_counter'
+    '''
+    rot_bonds = set(get_bond_indeces(mol, get_rot_bonds_posn(mol)))
+    if len(rot_bonds) == 0:                # no rotatable bonds: no ring fragments are recorded 
+        return [0, 0] + [0 for i in range(19)]
+    if any(atom.GetAtomicNum() == 1 or atom.GetIsotope() != 0 or atom.GetAtomMapNum() != 0 for atom in mol.GetAtoms()):
+        return ring_statistics_fragments(smi)
+
+    parent = list(range(mol.GetNumAtoms()))
+    def find(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+    for bond in mol.GetBonds():
+        if bond.GetIdx() not in rot_bonds:
+            parent[find(bond.GetBeginAtomIdx())] = find(bond.GetEndAtomIdx())
+
+    size, has_ring, num_triple, num_double = {}, {}, {}, {}
+    for atom in mol.GetAtoms():
+        root = find(atom.GetIdx())
+        size[root]     = size.get(root, 0) + 1
+        has_ring[root] = has_ring.get(root, False) or atom.IsInRing()
+    for bond in mol.GetBonds():
+        if bond.GetIdx() in rot_bonds:
+            continue
+        root = find(bond.GetBeginAtomIdx())
+        num_triple[root] = num_triple.get(root, 0) + (bond.GetBondType() == rdkit.Chem.rdchem.BondType.TRIPLE)
+        num_double[root] = num_double.get(root, 0) + (bond.GetBondType() == rdkit.Chem.rdchem.BondType.DOUBLE)
+
+    rings = [root for root in size if has_ring[root]]
+    if any(num_double.get(root, 0) >= 2 for root in rings):
+        return ring_statistics_fragments(smi)
+    return [len(rings), sum(num_triple.get(root, 0) for root in rings), 0] + [sum(1 for root in rings if size[root] == i) for i in range(3, 21)]
+
+
+def ring_statistics_fragments(smi):
+    '''Same as 'ring_statistics', calculated from the SMILES of the ring fragments of smi
+    '''
+    ring_ls = obtain_rings(smi)
+    num_triple = 0      # num triple bonds in ring
+    num_rings  = 0
+    if len(ring_ls) > 0 and ring_ls != (None, None):
+        for item in ring_ls:
+            num_triple += item.count('#')
+        num_rings = len(ring_ls)
+    return [num_rings, num_triple] + size_ring_counter(ring_ls)
+
+
+def mol_info_features(smi):
+    '''Calculate the 51 properties of 'get_mol_info' for SMILE string smi (as a list of numbers)
     '''
     mol = Chem.MolFromSmiles(smi)
-        
-    num_atoms   = mol.GetNumAtoms()       
-    num_hydro   = Chem.AddHs(mol).GetNumAtoms() - num_atoms 
-    num_carbon  = count_atoms(mol, 6)
-    num_nitro   = count_atoms(mol, 7)
-    num_sulphur = count_atoms(mol, 16)
-    num_oxy     = count_atoms(mol, 8)
-    num_clorine = count_atoms(mol, 17)
-    num_bromine = count_atoms(mol, 35)
-    num_florine = count_atoms(mol, 9)
 
+    # Count all atoms (and their hydrogens) in a single pass 
+    num_atoms   = mol.GetNumAtoms()
+    num_hydro   = 0
+    counts      = {}
+    for atom in mol.GetAtoms():
+        counts[atom.GetAtomicNum()] = counts.get(atom.GetAtomicNum(), 0) + 1
+        num_hydro += atom.GetTotalNumHs()
+    if counts.get(1, 0) > 0:    # explicit hydrogen atoms
+        num_hydro = Chem.AddHs(mol).GetNumAtoms() - num_atoms
+    num_carbon  = counts.get(6, 0)
     
     if num_carbon == 0: # Avoid division by zero error, set num_carbon to a very small value 
         num_carbon = 0.0001
     
-    basic_props = [num_atoms/num_carbon, num_hydro/num_carbon, num_nitro/num_carbon, 
-                     num_sulphur/num_carbon, num_oxy/num_carbon, num_clorine/num_carbon,
-                     num_bromine/num_carbon, num_florine/num_carbon]
-    
-    to_caculate = ["RingCount", "HallKierAlpha", "BalabanJ", "NumAliphaticCarbocycles","NumAliphaticHeterocycles",
-                   "NumAliphaticRings","NumAromaticCarbocycles","NumAromaticHeterocycles",
-                   "NumAromaticRings","NumHAcceptors","NumHDonors","NumHeteroatoms",
-                   "NumRadicalElectrons","NumSaturatedCarbocycles","NumSaturatedHeterocycles",
-                   "NumSaturatedRings","NumValenceElectrons"]    
-
-    # Calculate all propoerties listed in 'to_calculate'
-    calc_props = OrderedDict(inspect.getmembers(Descriptors, inspect.isfunction))
-    for key in list(calc_props.keys()):
-        if key.startswith('_'):
-            del calc_props[key]
-            continue
-        if len(to_caculate)!=0 and key not in to_caculate:
-            del calc_props[key]
-    features = [val(mol) for key,val in calc_props.items()] # List of properties 
-    
-    
-    # Ratio of total number of  (single, double, triple, aromatic) bonds to the total number of bonds. 
-    simple_bond_info = get_num_bond_types(mol) 
-    
-    # Obtain all rings in a molecule and calc. #of triple bonds in rings & #of rings in molecule 
-    ring_ls = obtain_rings(smi)
-    num_triple = 0      # num triple bonds in ring
+    basic_props = [num_atoms/num_carbon, num_hydro/num_carbon, counts.get(7, 0)/num_carbon, 
+                   counts.get(16, 0)/num_carbon, counts.get(8, 0)/num_carbon, counts.get(17, 0)/num_carbon,
+                   counts.get(35, 0)/num_carbon, counts.get(9, 0)/num_carbon]
 
+    # Calculate all propoerties listed in 'mol_info_descriptors'
+    features = [val(mol) for val in get_descriptor_functions()]
     
-    if len(ring_ls) > 0 and ring_ls != (None, None):
-        for item in ring_ls:
-            num_triple += item.count('#')
-        simple_bond_info.append(len(ring_ls))     # append number of Rings in molecule 
-    else:   simple_bond_info.append(0)            # no rotatable bonds
-
-        
-    simple_bond_info.append(num_triple)          # number of triple bonds in rings
-                                                 # appended onto 'simple_bond_info'
-                                              
-                                    
-    # Calculate the number of rings of size 3 to 20 & number of conseq. double bonds in rings 
-    simple_bond_info = simple_bond_info + size_ring_counter(ring_ls)
+    # Ratio of total number of  (single, double, triple, aromatic) bonds to the total number of bonds,
+    # number of ring fragments, number of triple bonds in them, and their sizes (see 'ring_statistics')
+    simple_bond_info = get_num_bond_types(mol) + ring_statistics(mol, smi)
     
     # Calculate the number of consequitve double bonds in entire molecule
     simple_bond_info.append(count_conseq_double(mol)) 
 
+    return features + basic_props + simple_bond_info
+
+
+def get_mol_info(smi):                 
+    ''' Calculate a set of 51 RdKit properties, collected from above helper functions. 
+    
+    Parameters:
+    smi (string) : SMILE string of molecule 
+    
+    Returns:
+    (list of float) : list of 51 calculated properties  
+    '''
+    return np.array(mol_info_features(smi))
+
+
+def get_mol_info_batch(smiles_list, out=None):
+    ''' Calculate the 51 properties of 'get_mol_info' for all smiles in smiles_list
+    
+    Parameters:
+    smiles_list (list)     : List of SMILE strings
+    out         (np.array) : Array of shape (len(smiles_list), 51) the results are written to (optional)
     
-    return np.array(features + basic_props + simple_bond_info)
+    Returns:
+    np.array : Results, shape (len(smiles_list), 51) (float32, unless out is given)
+    '''
+    if out is None:
+        out = np.zeros((len(smiles_list), mol_info_size), dtype=np.float32)
+    for idx, smi in enumerate(smiles_list):
+        out[idx] = mol_info_features(smi)
+    return out
     
 
 def get_chunks(arr, num_processors, ratio):
@@ -621,57 +782,68 @@ def get_mult_mol_info(smiles_list):
     smiles_list (list) : List of SMILE strings
     
     Returns:
-    np.array : Concatenated array of results with shape (len(smiles_list), 51)
+    np.array : Concatenated array of results with shape (len(smiles_list), 51), float32
                51 is the number of RdKit properties calculated in  'get_mol_info'.
     '''
-    concat_arr = []
-    for smi in smiles_list:
-        concat_arr.append(get_mol_info(smi))
-    return np.array(concat_arr)
+    return get_mol_info_batch(smiles_list)
     
 
-def get_mult_mol_info_parr(smiles_list, dataset_x):
-    ''' Record calculated rdkit property results for each smile in smiles_list,
-    and add record result in dictionary dataset_x.
+def get_mult_mol_info_parr(smiles_descriptors, dataset_descriptor, start, stop):
+    ''' Record calculated rdkit property results for molecules start to stop (of the packed
+    smiles in smiles_descriptors), in rows start to stop of the shared array dataset_descriptor.
     '''
-    for smi in smiles_list:
-        dataset_x['properties_rdkit'][smi] = get_mol_info(smi)
+    smiles_buffer, smiles_offsets = [SharedArray.attach(item) for item in smiles_descriptors]
+    dataset_x = SharedArray.attach(dataset_descriptor)
+    smiles_ls = [unpack_string(smiles_buffer.array, smiles_offsets.array, idx) for idx in range(start, stop)]
+    get_mol_info_batch(smiles_ls, out=dataset_x.array[start:stop])
+    for item in [smiles_buffer, smiles_offsets, dataset_x]:
+        item.close()
         
     
 def create_parr_process(chunks):
     '''This function initiates parallel execution (based on the number of cpu cores)
     to calculate all the properties mentioned in 'get_mol_info()'
     
+    Smiles are passed to the processes as a packed shared-memory buffer, and each process 
+    writes its results into its own rows of a shared (num. molecules, 51) float32 array.
+    
     Parameters:
     chunks (list)   : List of lists, contining smile strings. Each sub list is 
                       sent to a different process
-    dataset_x (dict): Locked dictionary for recording results from different processes. 
-                      Locking allows communication between different processes. 
                       
     Returns:
-    None : All results are recorde in dictionary 'dataset_x'
+    combined_dict (dict) : {smile: np.array of the 51 properties (float32)}
+    
+    Raises an Exception if any of the processes exits with a non-zero exit code.
     '''
+    smiles_ls = [smi for chunk in chunks for smi in chunk]
+    smiles_buffer, smiles_offsets = pack_strings(smiles_ls)
+    dataset_x = SharedArray((len(smiles_ls), mol_info_size), np.float32)
+    smiles_descriptors = (smiles_buffer.descriptor(), smiles_offsets.descriptor())
+
     # Assign data to each process 
     process_collector = []
-    collect_dictionaries = []
-    
+    start = 0
     for chunk in chunks:                # process initialization 
-        dataset_x         = manager.dict(lock=True)
-        smiles_map_props  = manager.dict(lock=True)
+        process_collector.append(multiprocessing.Process(target=get_mult_mol_info_parr, args=(smiles_descriptors, dataset_x.descriptor(), start, start+len(chunk), )))
+        start += len(chunk)
 
-        dataset_x['properties_rdkit'] = smiles_map_props
-        collect_dictionaries.append(dataset_x)
+    try:
+        for item in process_collector:      # initite all process 
+            item.start()
         
-        process_collector.append(multiprocessing.Process(target=get_mult_mol_info_parr, args=(chunk, dataset_x,  )))
-
-    for item in process_collector:      # initite all process 
-        item.start()
-    
-    for item in process_collector:      # wait for all processes to finish
-        item.join()   
-    
-    combined_dict = {}
-    for i,item in enumerate(collect_dictionaries):
-        combined_dict.update(item['properties_rdkit'])
+        for item in process_collector:      # wait for all processes to finish
+            item.join()   
+        
+        failed = [item.exitcode for item in process_collector if item.exitcode != 0]
+        if len(failed) > 0:                 # rows of a crashed process were never written
+            raise Exception('Descriptor calculation failed in {} process(es), exit codes: '.format(len(failed)), failed)
+        
+        combined_dict = {}
+        for idx, smi in enumerate(smiles_ls):
+            combined_dict[smi] = dataset_x.array[idx].copy()
+    finally:
+        for item in [smiles_buffer, smiles_offsets, dataset_x]:
+            item.unlink()
 
     return combined_dict
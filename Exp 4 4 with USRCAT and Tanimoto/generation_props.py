@@ -2,180 +2,470 @@
 Functions that are used while a Generation is being Evaluated 
 '''
 import os
+import json
 import random
+import hashlib
+import tempfile
 import multiprocessing
 from rdkit import Chem
 import numpy as np
 from random import randrange
 import discriminator as D
 import evolution_functions as evo
-from SAS_calculator.sascorer import calculateScore
-manager = multiprocessing.Manager()
-lock = multiprocessing.Lock()
+import selfies_tokens
+import selection
+from collections import OrderedDict
+from property_cache import PropertyCache
+from novelty_filter import BloomFilter
+from property_registry import PropertySpec, property_registry, register_property, get_property_specs
+from scheduling import estimate_cost, make_batches
+from shared_arrays import SharedArray, pack_strings, unpack_string, share_resource_tracker
+from SAS_calculator import sascorer
 
 #Added to deal with Similarity:                                         #!# ----------------------------------------
-from rdkit.Chem import AllChem
-from rdkit.Chem.rdMolDescriptors import GetUSRScore, GetUSRCAT
+import usrcat
+import reference_set
+#Added to deal with Tanimoto
+from rdkit import DataStructs
+
+# Static state of a worker process (filled once per worker by 'init_worker')
+_worker_state = {}
+
+# Temporary directory of the reference sets prepared by 'create_worker_pool' without a reference_dir 
+# (removed when the interpreter exits)
+_reference_tmp = None
+
 
-def calc_prop_USR(unseen_smile_ls, property_name, props_collect):
-    '''Calculate Similarity for each molecule in unseen_smile_ls, and record results
-       in locked dictionary props_collect 
+def init_worker(starting_smile, usrcat_settings, reference_dir):
+    '''Initializer of the worker pool: prepare everything that does not change during a run, 
+       once per worker process
+
+    Parameters:
+    starting_smile  (string) : Molecule that the similarity constraint (SIMILR) is measured against
+    usrcat_settings (dict)   : Settings of the USRCAT Similarity calculation (see usrcat.default_settings)
+    reference_dir   (string) : Directory of the reference set prepared by 'create_worker_pool'
     '''
+    # Reference molecule(s) for USRCAT & Tanimoto Similarity (identical in all workers)   #!#
+    reference = reference_set.load_reference(reference_dir)
+    _worker_state['ref_embed_usrcat'] = reference['usrcat']
+    _worker_state['ref_conf_ref']     = reference['conf_ref']
+    _worker_state['Tani_ref_FPs']     = reference['fps']
+    _worker_state['usrcat_settings']  = usrcat.get_settings(usrcat_settings)
+
+    # Target of the similarity constraint, and its fingerprint
+    _worker_state['target'], _, _ = evo.sanitize_smiles(starting_smile)
+    _worker_state['target_FP']    = evo.get_morgan_fingerprint(_worker_state['target'])
+
+    # Static resources (no-op if they were inherited from the parent process)
+    preload_static_resources()
 
-    #To provide reference molecule:
-    reference_smile = 'C1(=NC(=NC2=C1N=C[N]2[H])N(C3=CC=C(C=C3)[S](=O)(=O)N([H])[H])[H])C4=CC(=CC=C4)C5=CC=CC=C5'
-    ref_mol = Chem.MolFromSmiles(reference_smile)
-    AllChem.EmbedMolecule(ref_mol, useRandomCoords = True, enforceChirality = False)
-    ref_embed_usrcat = GetUSRCAT(ref_mol)
+
+def preload_static_resources():
+    '''Load the static resources used by the property calculations: the SAS fragment scores 
+       (otherwise unpickled by the first call to calculateScore) and the SMARTS patterns of
+       evo.get_mol_info. Resources already loaded in this process are not loaded again.
+
+    Called in the parent before the worker processes are started, so that workers created by
+    forking (or by a fork server, see 'worker_preload.py') inherit them copy-on-write.
+    '''
+    if sascorer._fscores is None:
+        sascorer.readFragmentScores()
+    evo.preload_smarts()
+
+
+def create_worker_pool(num_processors, starting_smile, usrcat_settings=None, 
+                       reference_smile=reference_set.default_reference_smile, reference_dir=None, start_method=None):
+    '''Create the pool of worker processes used for property calculations, for an entire run.
     
-    for smile in unseen_smile_ls:
-        mol, smi_canon, did_convert = evo.sanitize_smiles(smile) #esure valid smile
-        if did_convert:
-            try:
-                mol_test = Chem.MolFromSmiles(smile)
-                mol_test = Chem.AddHs(mol_test)
-                AllChem.EmbedMolecule(mol_test, useRandomCoords = True, enforceChirality = False)
-                mol_test = Chem.RemoveHs(mol_test)
-                UsrcatMol = GetUSRCAT(mol_test)
-            except ValueError: 
-                SimScore = 0
-            else:
-                SimScore = GetUSRScore(ref_embed_usrcat, UsrcatMol)
-            props_collect[property_name][smile] = SimScore
-        else:
-            raise Exception('Invalid smile encountered while atempting to calculate Similarity') #!# ----------------
+    The reference molecule (or list of reference molecules, scored as a panel) is embedded once, 
+    here, and stored in reference_dir, from where all workers load the same reference conformers. 
+    If reference_dir is None, the set is kept in a temporary directory shared by all pools of the 
+    process, so that a reference prepared for an earlier pool (with the same molecules and settings) 
+    is not embedded again; the directory is removed when the interpreter exits.
+
+    start_method is the multiprocessing start method of the workers (None: platform default). 
+    With 'forkserver', the fork server preloads the static resources (see 'preload_static_resources').
+    '''
+    global _reference_tmp
+    if isinstance(reference_smile, str):
+        reference_smile = [reference_smile]
+    if reference_dir is None:
+        if _reference_tmp is None:
+            _reference_tmp = tempfile.TemporaryDirectory(prefix='reference_')
+        key           = json.dumps([reference_smile, usrcat.get_settings(usrcat_settings)], sort_keys=True)
+        reference_dir = os.path.join(_reference_tmp.name, hashlib.sha1(key.encode('utf-8')).hexdigest())
+    reference_set.prepare_reference(reference_smile, usrcat_settings, reference_dir)
+    context = multiprocessing.get_context(start_method)
+    if context.get_start_method() == 'forkserver':
+        context.set_forkserver_preload(['worker_preload'])
+    else:
+        preload_static_resources()
+    share_resource_tracker()
+    return context.Pool(processes=num_processors, initializer=init_worker, initargs=(starting_smile, usrcat_settings, reference_dir, ))
 
-#Added to deal with Tanimoto
-from rdkit import DataStructs
 
-def calc_prop_Tanimoto(unseen_smile_ls, property_name, props_collect):                  #-------------------------
-    '''Calculate Tanimoto Coeff. for each molecule in unseen_smile_ls, and record results
-       in locked dictionary props_collect 
+def calc_prop_USR(mol):
+    '''Calculate USRCAT Similarity of mol to the reference conformer set
+
+    With usrcat_settings['num_confs'] > 1, an ensemble of conformers is embedded and 
+    the scores of all conformers are combined (max or mean, usrcat_settings['fusion']).
+    mol is embedded once, and scored against the conformers of all references in one matrix; 
+    with several references, their scores are combined with usrcat_settings['ref_fusion'].
+    The embedding strategy that succeeded is left in _worker_state['embed_tier'].
+    
+    Returns:
+    (float) : Similarity score (None if no 3D embedding of mol could be obtained)
     '''
+    settings = _worker_state['usrcat_settings']
+    try:
+        mol_test, conf_ids, _worker_state['embed_tier'] = usrcat.embed_conformers(mol, settings)
+        if len(conf_ids) == 0:
+            raise ValueError('No conformer could be embedded')
+        UsrcatMol = usrcat.get_usrcat_descriptors(mol_test, conf_ids)
+    except ValueError: 
+        return None
+    scores = usrcat.usrcat_score_matrix(UsrcatMol, _worker_state['ref_embed_usrcat'])      #!#
+    return usrcat.fuse_scores(scores, _worker_state['ref_conf_ref'], settings)
+
+
+def calc_bulk_Tanimoto(mols):                                                                  #!#
+    '''Calculate Tanimoto Coeff. of all mols to the reference molecule(s), one bulk comparison per reference.
+       Scores against several references are combined with usrcat_settings['ref_fusion']
+    '''
+    Tani_mol_FPs = [Chem.RDKFingerprint(mol) for mol in mols]
+    scores       = [DataStructs.BulkTanimotoSimilarity(ref_FP, Tani_mol_FPs) for ref_FP in _worker_state['Tani_ref_FPs']]
+    return usrcat.fuse_references(scores, _worker_state['usrcat_settings'])
 
-    #To provide reference molecule:
-    reference_smile = 'C1(=NC(=NC2=C1N=C[N]2[H])N(C3=CC=C(C=C3)[S](=O)(=O)N([H])[H])[H])C4=CC(=CC=C4)C5=CC=CC=C5'
-    Tani_ref_mol = Chem.MolFromSmiles(reference_smile)
-    Tani_ref_FP = Chem.RDKFingerprint(Tani_ref_mol)
-
-    for smile in unseen_smile_ls:
-        mol, smi_canon, did_convert = evo.sanitize_smiles(smile) #esure valid smile
-        if did_convert:
-            mol_Tani_test = Chem.MolFromSmiles(smile)
-            Tani_mol_FP = Chem.RDKFingerprint(mol_Tani_test)
-            TaniScore = DataStructs.FingerprintSimilarity(Tani_mol_FP, Tani_ref_FP)
-            props_collect[property_name][smile] = TaniScore
-        else:
-            raise Exception('Invalid smile encountered while atempting to calculate Tanimoto') #----------------
 
-def calc_prop_logP(unseen_smile_ls, property_name, props_collect):
-    '''Calculate logP for each molecule in unseen_smile_ls, and record results
-       in locked dictionary props_collect 
+def calc_prop_logP(mol):
+    '''Calculate logP of mol
     '''
-    for smile in unseen_smile_ls:
-        mol, smi_canon, did_convert = evo.sanitize_smiles(smile)
-        if did_convert:                                          # ensure valid smile 
-            props_collect[property_name][smile] = evo.get_logP(mol) # Add calculation
-        else:
-            raise Exception('Invalid smile encountered while atempting to calculate logP')
+    return evo.get_logP(mol)
 
         
-def calc_prop_SAS(unseen_smile_ls, property_name, props_collect):
-    '''Calculate synthetic accesibility score for each molecule in unseen_smile_ls,
-       results are recorded in locked dictionary props_collect 
+def calc_prop_SAS(mol):
+    '''Calculate synthetic accesibility score of mol
     '''
-    for smile in unseen_smile_ls:
-        mol, smi_canon, did_convert = evo.sanitize_smiles(smile)
-        if did_convert:                                         # ensure valid smile 
-            props_collect[property_name][smile] = calculateScore(mol)
-        else:
-            raise Exception('Invalid smile encountered while atempting to calculate SAS ', smile)
+    return sascorer.calculateScore(mol)
 
-    
 
-def calc_prop_RingP(unseen_smile_ls, property_name, props_collect):
-    '''Calculate Ring penalty for each molecule in unseen_smile_ls,
-       results are recorded in locked dictionary props_collect 
+def calc_prop_RingP(mol):
+    '''Calculate Ring penalty of mol (size of the largest ring beyond 6 atoms)
     '''
-    for smi in unseen_smile_ls:
-        mol, smi_canon, did_convert = evo.sanitize_smiles(smi)
-        if did_convert:    
-            cycle_list = mol.GetRingInfo().AtomRings() 
-            if len(cycle_list) == 0:
-                cycle_length = 0
-            else:
-                cycle_length = max([ len(j) for j in cycle_list ])
-            if cycle_length <= 6:
-                cycle_length = 0
-            else:
-                cycle_length = cycle_length - 6
-            props_collect[property_name][smi] = cycle_length
-        else:
-            raise Exception('Invalid smile encountered while atempting to calculate Ring penalty ', smi)
+    cycle_list = mol.GetRingInfo().AtomRings() 
+    if len(cycle_list) == 0:
+        cycle_length = 0
+    else:
+        cycle_length = max([ len(j) for j in cycle_list ])
+    if cycle_length <= 6:
+        cycle_length = 0
+    else:
+        cycle_length = cycle_length - 6
+    return cycle_length
             
             
-def calc_prop_SIMIL(starting_smile, unseen_smile_ls, property_name, props_collect):
-    '''Calculate logP for each molecule in unseen_smile_ls, and record results
-       in locked dictionary props_collect 
+def calc_bulk_SIMIL(mols):
+    '''Calculate similarity of all mols to the starting molecule (see evo.molecule_similarity), 
+       in a single bulk comparison
     '''
-    target, _, _ = evo.sanitize_smiles(starting_smile)
+    fps = [evo.get_morgan_fingerprint(mol) for mol in mols]
+    return DataStructs.BulkTanimotoSimilarity(_worker_state['target_FP'], fps)
 
-    for smile in unseen_smile_ls:
-        mol, smi_canon, did_convert = evo.sanitize_smiles(smile)
-        if did_convert:                                                                # ensure valid smile 
-            props_collect[property_name][smile] = evo.molecule_similarity(mol, target) # Add calculation
-        else:
-            raise Exception('Invalid smile encountered while atempting to calculate SIMILARITY: ', smile)
 
+def similarity_penalty(values, desired_delta):
+    '''Penalty of the similarity constraint: molecules with a similarity to the starting 
+       molecule at or below desired_delta are excluded (-10**6)
+    '''
+    return np.where(np.asarray(values) > desired_delta, 0, -10**6)
+
+
+# Properties that can be requested in 'properties_calc_ls' (see property_registry.py). 
+# Standardization is based on the mean & stddev of the zinc / ChemBL data sets; these defaults
+# are replaced by the statistics of a stats file built with build_norm_stats.py, if one is given
+register_property(PropertySpec('logP',    'diagnostic', compute=calc_prop_logP,                         # zinc logP (mean: 2.4729421499641497 & std : 1.4157879815362406)
+                               norm=(2.4729421499641497, 1.4157879815362406),  
+                               label='logP',     log_name='logp',  file_name='logp',  ordered_file='logP_ordered',  best='max'))
+register_property(PropertySpec('SAS',     'diagnostic', compute=calc_prop_SAS,                          # zinc SAS(mean: 3.0470797085649894    & std: 0.830643172314514)
+                               norm=(3.0470797085649894, 0.830643172314514),   
+                               label='sas',      log_name='sas',   file_name='SAS',   ordered_file='sas_ordered',   best='min'))
+register_property(PropertySpec('RingP',   'diagnostic', compute=calc_prop_RingP,                        # zinc RingP(mean: 0.038131530820234766 & std: 0.2240274735210179)
+                               norm=(0.038131530820234766, 0.2240274735210179), 
+                               label='ringP',    log_name='ringp', file_name='RingP', ordered_file='ringP_ordered', best='min'))
+register_property(PropertySpec('SIMILR',  'constraint', batch_compute=calc_bulk_SIMIL, cost='fingerprint', penalty=similarity_penalty, 
+                               label='similarity'))
+register_property(PropertySpec('USRSim',  'objective',  compute=calc_prop_USR, cost='embedding',         # ChemBL USRCAT Similarity to the reference(mean: 0.186428542 & std: 0.035664915)  #!#
+                               norm=(0.186428542, 0.035664915), 
+                               label='USRCAT',   log_name='USRCAT Similarity',   file_name='Similarity', ordered_file='USRCATSimilarity_ordered', best='max'))
+register_property(PropertySpec('TaniSim', 'diagnostic', batch_compute=calc_bulk_Tanimoto, cost='fingerprint',  # ChemBL Tanimoto Similarity(mean: 0.350252265668509 & std: 0.0681108949632873) #!#
+                               norm=(0.350252265668509, 0.0681108949632873), 
+                               label='Tanimoto', log_name='Tanimoto Similarity', file_name='Tanimoto',   ordered_file='Tanimoto_ordered',         best='max'))
+
+# Which molecules diagnostic properties are calculated for. Values given to 'initiate_ga' 
+# (diagnostic_settings) override these defaults.
+#   mode  : 'all', 'top_k' (the 'count' molecules with the highest fitness), 'sample' (a random sample 
+#           of 'count' molecules) or 'off'. Diagnostics of other molecules are recorded as NaN
+#   count : Number of molecules for 'top_k' and 'sample'
+default_diagnostic_settings = {'mode':  'all',
+                               'count': 100,
+                              }
+
+
+def attach_batch(batch):
+    '''Attach a worker to the shared arrays of a batch (see 'create_parr_process'). 
+       The arrays of the previous batch are released when a new batch is seen.
+    '''
+    if _worker_state.get('batch') != batch:
+        for item in _worker_state.get('batch_arrays', []):
+            item.close()
+        _worker_state['batch_arrays'] = [SharedArray.attach(descriptor) for descriptor in batch[:5]]
+        _worker_state['batch']        = batch
+    return [item.array for item in _worker_state['batch_arrays']]
+
+
+def calc_props_fused(task):
+    '''Evaluate a set of molecules in a worker process. Each molecule is parsed once, 
+       and all requested properties are calculated from the same mol object.
+       Properties with a batch_compute function (eg. fingerprint similarities) are 
+       calculated for all molecules of the set at once.
+
+    Molecules are read from, and results are written to, the shared arrays of the batch;
+    nothing but the number of evaluated molecules is sent back to the parent process.
+    
+    Parameters:
+    task (tuple) : (batch, array of molecule indices, list of property names)
+    '''
+    batch, index_ls, properties_calc_ls = task
+    smiles_buffer, smiles_offsets, results, failed, embed_tier = attach_batch(batch)
+    rows  = [batch[5].index(name) for name in properties_calc_ls] # row of each property in results
+    specs = [property_registry[name] for name in properties_calc_ls]
+
+    mols = []
+    for idx in index_ls:
+        smile = unpack_string(smiles_buffer, smiles_offsets, idx)
+        mol, smi_canon, did_convert = evo.sanitize_smiles(smile) # ensure valid smile 
+        if not did_convert:
+            raise Exception('Invalid smile encountered while atempting to calculate properties: ', smile)
+        mols.append(mol)
+
+    for idx, mol in zip(index_ls, mols):
+        _worker_state['embed_tier'] = -1
+        for spec, row in zip(specs, rows):
+            if spec.batch_compute is not None:
+                continue
+            value = spec.compute(mol)
+            if value is None:       # eg. no 3D embedding could be found for USRSim
+                failed[idx] = True
+                value = 0
+            results[row, idx] = value
+        embed_tier[idx] = _worker_state['embed_tier']
+
+    for spec, row in zip(specs, rows):
+        if spec.batch_compute is not None:
+            results[row, index_ls] = spec.batch_compute(mols)
+    return len(index_ls)
+
+
+def create_parr_process(worker_pool, molecules, tasks, properties_calc_ls):
+    ''' Calculate properties of molecules using the processes of worker_pool. 
+
+    The molecules are passed to the workers as a packed shared-memory buffer, and workers
+    write results directly into a shared (property, molecule) array. 
 
-def create_parr_process(chunks, property_name, starting_smile):
-    ''' Create parallel processes for calculation of properties
+    Parameters:
+    worker_pool        (Pool) : Worker processes created by 'create_worker_pool'
+    molecules          (list) : SMILES strings of all molecules to be evaluated
+    tasks              (list) : List of tuples (array of indices into molecules, list of property names); 
+                                each tuple is evaluated by a single worker, in the order given
+    properties_calc_ls (list) : All property names appearing in tasks
+    
+    Returns:
+    results    (np.array) : Shape (len(properties_calc_ls), len(molecules)); NaN if not calculated
+    failed     (np.array) : True for molecules for which a calculation failed (value recorded as 0)
+    embed_tier (np.array) : Index in usrcat.embedding_tiers of the embedding strategy that succeeded
+                            for each molecule (-1: not embedded, or all strategies failed)
     '''
-    # Assign data to each process 
-    process_collector    = []
-    collect_dictionaries = []
-        
-    for item in chunks:
-        props_collect  = manager.dict(lock=True)
-        smiles_map_    = manager.dict(lock=True)
-        props_collect[property_name] = smiles_map_
-        collect_dictionaries.append(props_collect)
-        
-        if property_name == 'logP':
-            process_collector.append(multiprocessing.Process(target=calc_prop_logP, args=(item, property_name, props_collect, )))
-        
-        if property_name == 'SAS': 
-           process_collector.append(multiprocessing.Process(target=calc_prop_SAS, args=(item, property_name, props_collect, )))
-            
-        if property_name == 'RingP': 
-            process_collector.append(multiprocessing.Process(target=calc_prop_RingP, args=(item, property_name, props_collect, )))
-            
-        if property_name == 'SIMILR': 
-            process_collector.append(multiprocessing.Process(target=calc_prop_SIMIL, args=(starting_smile, item, property_name, props_collect, )))
+    smiles_buffer, smiles_offsets = pack_strings(molecules)
+    results    = SharedArray((len(properties_calc_ls), len(molecules)), np.float64, fill=np.nan)
+    failed     = SharedArray((len(molecules), ), np.bool_, fill=False)
+    embed_tier = SharedArray((len(molecules), ), np.int8,  fill=-1)
+    batch      = (smiles_buffer.descriptor(), smiles_offsets.descriptor(), results.descriptor(), failed.descriptor(), 
+                  embed_tier.descriptor(), list(properties_calc_ls))
+    try:
+        for _ in worker_pool.imap_unordered(calc_props_fused, [(batch, index_ls, names) for index_ls, names in tasks], chunksize=1):
+            pass
+        return results.array.copy(), failed.array.copy(), embed_tier.array.copy()
+    finally:
+        for item in [smiles_buffer, smiles_offsets, results, failed, embed_tier]:
+            item.unlink()
+
+
+def schedule_tasks(molecules, index_ls, names, num_processors):
+    '''Split molecules[index_ls] into batches for the worker pool (see scheduling.make_batches), 
+       each to be evaluated for the properties in names
 
-        if property_name == 'USRSim':               #!# 
-            process_collector.append(multiprocessing.Process(target=calc_prop_USR, args=(item, property_name, props_collect, )))
+    Returns:
+    (list) : Tasks for 'create_parr_process' 
+    '''
+    if len(index_ls) == 0 or len(names) == 0:
+        return []
+    costs = estimate_cost([molecules[idx] for idx in index_ls], embedding=any(property_registry[name].cost == 'embedding' for name in names))
+    return [(item, names) for item in make_batches(index_ls, costs, num_processors)]
 
-        if property_name == 'TaniSim':               #!# 
-            process_collector.append(multiprocessing.Process(target=calc_prop_Tanimoto, args=(item, property_name, props_collect, )))
-    
-    
-    for item in process_collector:
-        item.start()
-    
-    for item in process_collector: # wait for all parallel processes to finish
-        item.join()   
-        
-    combined_dict = {}             # collect results from multiple processess
-    for i,item in enumerate(collect_dictionaries):
-        combined_dict.update(item[property_name])
 
-    return combined_dict
+def calculate_properties(worker_pool, molecules_here_unique, properties_calc_ls, num_processors, property_cache=None, embed_tiers=None,
+                         gate_delta=None):
+    '''Calculate all properties in properties_calc_ls for the (unique) molecules in molecules_here_unique
+
+    If embed_tiers (dict) is provided, it is updated with {smile: index in usrcat.embedding_tiers}
+    for all molecules embedded in 3D by this call (-1 if all strategies failed)
+
+    If gate_delta is given (and a constraint is calculated), all other properties are calculated first,
+    and properties that need a 3D embedding only for molecules that satisfy all constraints; the other
+    molecules are penalized in 'fitness' whatever their value, which is recorded as NaN.
+
+    Returns:
+    cached_results (dict) : {property_name: {smile: value}} for all molecules
+    '''
+    specs = get_property_specs(properties_calc_ls)
+
+    # Properties that may not be reused are calculated without the cache
+    uncacheable = [spec.name for spec in specs if not spec.cacheable]
+    if property_cache is not None and len(uncacheable) > 0:
+        cacheable      = [spec.name for spec in specs if spec.cacheable]
+        cached_results = calculate_properties(worker_pool, molecules_here_unique, cacheable,   num_processors, property_cache, embed_tiers, gate_delta)
+        cached_results.update(calculate_properties(worker_pool, molecules_here_unique, uncacheable, num_processors, None, embed_tiers, gate_delta))
+        return cached_results
+
+    # Only molecules without cached properties (mostly new mutations) are sent to the workers
+    if property_cache is None:
+        property_cache = PropertyCache(max_size=0, max_failed=0)
+    cached_results, molecules_to_calc = property_cache.lookup(molecules_here_unique, properties_calc_ls)
+
+    # Molecules that previously failed to embed are not attempted again, and score 0 for properties that need an embedding
+    molecules_failed  = [smi for smi in molecules_to_calc if property_cache.is_failed(smi)]
+    molecules_to_calc = [smi for smi in molecules_to_calc if not property_cache.is_failed(smi)]
+    properties_embed  = [spec.name for spec in specs if spec.cost == 'embedding']
+    properties_flat   = [spec.name for spec in specs if spec.cost != 'embedding']
+    constraints       = [spec for spec in specs if spec.role == 'constraint' and spec.cost != 'embedding']
+
+    # All properties of a molecule are calculated in a single pass, by the same worker.
+    # Batches are dispatched most expensive first, from the shared task queue of the pool
+    molecules  = molecules_to_calc + molecules_failed
+    index_calc = np.arange(0, len(molecules_to_calc))
+    index_fail = np.arange(len(molecules_to_calc), len(molecules))
+    if gate_delta is None or len(properties_embed) == 0 or len(constraints) == 0:
+        tasks  = schedule_tasks(molecules, index_calc, properties_calc_ls, num_processors)
+        tasks += schedule_tasks(molecules, index_fail, properties_flat,    num_processors)
+        results, failed, embed_tier = create_parr_process(worker_pool, molecules, tasks, properties_calc_ls)
+        index_embed = index_calc
+    else:
+        # Cheap properties first: the 3D embedding is only needed for molecules that satisfy
+        # the constraints (the others are penalized in 'fitness' regardless)
+        tasks   = schedule_tasks(molecules, np.arange(0, len(molecules)), properties_flat, num_processors)
+        results, failed, embed_tier = create_parr_process(worker_pool, molecules, tasks, properties_calc_ls)
+        penalty = np.zeros((len(index_calc), ))
+        for spec in constraints:
+            penalty += spec.penalty(results[properties_calc_ls.index(spec.name), index_calc], gate_delta)
+        index_embed = index_calc[penalty == 0]
+        tasks   = schedule_tasks(molecules, index_embed, properties_embed, num_processors)
+        results_embed, failed_embed, embed_tier = create_parr_process(worker_pool, molecules, tasks, properties_calc_ls)
+        for name in properties_embed:
+            results[properties_calc_ls.index(name)] = results_embed[properties_calc_ls.index(name)]
+        failed |= failed_embed
+    if embed_tiers is not None and len(properties_embed) > 0:
+        embed_tiers.update((molecules[idx], int(embed_tier[idx])) for idx in index_embed)
+    for name in properties_embed:
+        results[properties_calc_ls.index(name), index_fail] = 0  # molecules that previously failed to embed
+
+    calculated_results = {}
+    for row, name in enumerate(properties_calc_ls):
+        calculated_results[name] = dict(zip(molecules, results[row].tolist()))
+    property_cache.mark_failed([smi for smi, did_fail in zip(molecules, failed) if did_fail])
+
+    property_cache.update(calculated_results)
+    for name in calculated_results:
+        cached_results[name].update(calculated_results[name])
+
+    return cached_results
+
+
+def objective_fitness(num_molecules, calculated, standardized, desired_delta):
+    '''Fitness of molecules without discriminator: the weighted sum of the standardized objectives
+       (not calculated: counts as 0), plus the penalties of the constraints
+
+    Parameters:
+    num_molecules (int)   : Number of molecules
+    calculated    (dict)  : {property_name: np.array of values}, see 'obtained_standardized_properties'
+    standardized  (dict)  : {property_name: np.array of standardized values, shape (num_molecules, 1)}
+    desired_delta (float) : Threshold of the constraints (see PropertySpec.penalty)
+
+    Returns:
+    (np.array) : Shape (num_molecules, 1)
+    '''
+    fitness = np.zeros((num_molecules, 1))
+    for name in calculated:
+        spec = property_registry[name]
+        if spec.role == 'objective':
+            fitness = fitness + spec.weight * np.nan_to_num(standardized[name], nan=0.0)
+        elif spec.role == 'constraint':
+            fitness = fitness + spec.penalty(calculated[name], desired_delta).reshape((num_molecules, 1))
+    return fitness
+
+
+def select_diagnostic_molecules(molecules_here_unique, fitness_unique, diagnostic_settings=None, rng=None):
+    '''Choose the molecules for which diagnostic properties are calculated (see 'default_diagnostic_settings').
+
+    Parameters:
+    molecules_here_unique (list)                : Unique SMILES of the generation
+    fitness_unique        (np.array)            : Fitness of each molecule (see 'objective_fitness'), used by mode 'top_k'
+    diagnostic_settings   (dict)                : Overrides of 'default_diagnostic_settings'
+    rng                   (np.random.Generator) : Random numbers of mode 'sample' (None: the global random state)
+
+    Returns:
+    (list) : SMILES of the chosen molecules
+    '''
+    settings = dict(default_diagnostic_settings)
+    settings.update(diagnostic_settings or {})
+    if settings['mode'] == 'all':
+        return list(molecules_here_unique)
+    if settings['mode'] == 'off':
+        return []
+    if settings['mode'] == 'sample':
+        count = min(settings['count'], len(molecules_here_unique))
+        if rng is None:
+            return random.sample(list(molecules_here_unique), count)
+        return [molecules_here_unique[idx] for idx in rng.choice(len(molecules_here_unique), count, replace=False)]
+    if settings['mode'] == 'top_k':
+        order = np.argsort(-np.asarray(fitness_unique).reshape(-1), kind='stable')
+        return [molecules_here_unique[idx] for idx in order[:settings['count']]]
+    raise Exception('Invalid diagnostic mode. Only possible choices are: all/top_k/sample/off')
+
+
+def nan_stat(stat, values):
+    '''Apply stat (eg. np.nanmax) to values, ignoring NaN (not calculated); NaN if no value is available
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if np.all(np.isnan(values)):
+        return np.nan
+    return stat(values)
+
+
+def write_stat(data_dir, generation_index, name, value, results_store=None):
+    '''Record a statistic of a generation: in results_store (see results_store.py) if given, 
+       otherwise appended to '<data_dir>/<name>.txt'
+    '''
+    if results_store is not None:
+        results_store.add_stat(generation_index, name, value)
+        return
+    f = open('{}/{}.txt'.format(data_dir, name), 'a+')
+    f.write(str(value) + '\n')
+    f.close()
 
 
 def fitness(molecules_here,    properties_calc_ls,  
             discriminator,     disc_enc_type,   generation_index,
-            max_molecules_len, device,          num_processors,    writer, beta, data_dir, starting_smile, desired_delta, save_curve):
+            max_molecules_len, device,          num_processors,    writer, beta, data_dir, starting_smile, desired_delta, save_curve,
+            property_cache=None, worker_pool=None, diagnostic_settings=None, results_store=None, diagnostic_rng=None):
     ''' Calculate fitness fo a generation in the GA
     
     All properties are standardized based on the mean & stddev of the zinc dataset
@@ -188,11 +478,18 @@ def fitness(molecules_here,    properties_calc_ls,
     generation_index  (int)          : Which generation indicator
     max_molecules_len (int)          : Largest mol length
     device            (string)       : Device of discrimnator  
+    property_cache    (PropertyCache): Run-scoped cache of properties from earlier generations (optional)
+    worker_pool       (Pool)         : Worker processes created by 'create_worker_pool' (optional)
+    diagnostic_settings (dict)       : Which molecules diagnostic properties are calculated for 
+                                       (see 'default_diagnostic_settings'); others are NaN
+    results_store     (ResultsStore) : Statistics are recorded here instead of text files (optional)
+    diagnostic_rng    (np.random.Generator) : Random numbers of the diagnostic mode 'sample' (None: the global random state)
         
     Returns:
     fitness                   (np.array) : A lin comb of properties and 
                                            discriminator predictions
-    discriminator_predictions (np.array) : The predictions made by the discrimantor
+    calculated                (dict)     : {property_name: np.array of (non standardized) values 
+                                           of molecules_here}, NaN if not calculated
     
     '''    
     if properties_calc_ls == None:
@@ -201,51 +498,56 @@ def fitness(molecules_here,    properties_calc_ls,
     
     else:
         
-        molecules_here_unique = list(set(molecules_here))      
-        
-        
-        ratio            = len(molecules_here_unique) / num_processors 
-        chunks           = evo.get_chunks(molecules_here_unique, num_processors, ratio) 
-        chunks           = [item for item in chunks if len(item) >= 1]
-        # Parallelize the calculation of logPs
-        if 'logP' in properties_calc_ls:
-            logP_results = create_parr_process(chunks, 'logP', starting_smile)
-
-        # Parallelize the calculation of SAS
-        if 'SAS' in properties_calc_ls:
-            SAS_results = create_parr_process(chunks, 'SAS', starting_smile)
-
-        # Parallize the calculation of Ring Penalty
-        if 'RingP' in properties_calc_ls:
-            ringP_results = create_parr_process(chunks, 'RingP', starting_smile)
-
-        # Parallelize the calculation of SIMILR    
-        if 'SIMILR' in properties_calc_ls:
-            similar_results = create_parr_process(chunks, 'SIMILR', starting_smile)
-
-        # Parallize the calculation of USRCAT Sim                               #!#
-        if 'USRSim' in properties_calc_ls:
-            USRSim_results = create_parr_process(chunks, 'USRSim', starting_smile)
-
-        # Parallize the calculation of Tanimoto                                 #!#
-        if 'TaniSim' in properties_calc_ls:
-            TaniSim_results = create_parr_process(chunks, 'TaniSim', starting_smile)
+        specs                 = get_property_specs(properties_calc_ls)
+        properties_fitness    = [spec.name for spec in specs if spec.role != 'diagnostic']
+        properties_diagnostic = [spec.name for spec in specs if spec.role == 'diagnostic']
+        molecules_here_unique = list(OrderedDict.fromkeys(molecules_here))   # (in a reproducible order)
+
+        # A temporary pool is used if the run does not provide one
+        own_pool = worker_pool is None
+        if own_pool:
+            worker_pool = create_worker_pool(num_processors, starting_smile)
+        # With diagnostic mode 'all', diagnostic properties are calculated in the same pass as the others
+        # (except those that need an embedding, which the constraints would skip for some molecules)
+        properties_first = list(properties_fitness)
+        if dict(default_diagnostic_settings, **(diagnostic_settings or {}))['mode'] == 'all':
+            properties_first     += [spec.name for spec in specs if spec.role == 'diagnostic' and spec.cost != 'embedding']
+            properties_diagnostic = [name for name in properties_diagnostic if name not in properties_first]
+        embed_tiers = {}
+        try:
+            cached_results = calculate_properties(worker_pool, molecules_here_unique, properties_first, num_processors, property_cache, embed_tiers, 
+                                                  gate_delta=desired_delta)
+            # Diagnostic properties, only for the molecules chosen by diagnostic_settings
+            if len(properties_diagnostic) > 0:
+                calculated, standardized = obtained_standardized_properties(molecules_here_unique, cached_results, properties_fitness)
+                fitness_unique           = objective_fitness(len(molecules_here_unique), calculated, standardized, desired_delta)
+                diagnostic_molecules     = select_diagnostic_molecules(molecules_here_unique, fitness_unique, diagnostic_settings, diagnostic_rng)
+                cached_results.update(calculate_properties(worker_pool, diagnostic_molecules, properties_diagnostic, num_processors, property_cache))
+        finally:
+            if own_pool:
+                worker_pool.terminate()
+
+        # Record the embedding strategy that succeeded for each newly embedded molecule         #!#
+        tier_names = usrcat.embedding_tiers + ['failed']
+        for tier_idx, tier_name in enumerate(tier_names):
+            writer.add_scalar('embedding tier {}'.format(tier_name), sum(1 for x in embed_tiers.values() if tier_names[x] == tier_name), generation_index)
+        if results_store is not None:
+            results_store.add_embedding_tiers(generation_index, [(smi, tier_names[x]) for smi, x in embed_tiers.items()])
+        else:
+            f = open('{}/embedding_tiers.txt'.format(data_dir), 'a+')
+            f.writelines(['{} {} {}\n'.format(generation_index, smi, tier_names[x]) for smi, x in embed_tiers.items()])
+            f.close()
 
+        calculated, standardized = obtained_standardized_properties(molecules_here, cached_results, properties_calc_ls)
         
-        logP_calculated, SAS_calculated, RingP_calculated, logP_norm, SAS_norm, RingP_norm, Similarity_calculated, USRSim_calculated, USRSim_norm, TaniSim_calculated, TaniSim_norm = obtained_standardized_properties(molecules_here, logP_results, SAS_results, ringP_results, similar_results, USRSim_results, TaniSim_results)
-        
-        # Add Objectives
-        fitness = (USRSim_norm)
+        # Add Objectives, and penalties of the constraints (eg. similarity to the starting molecule)
+        fitness = objective_fitness(len(molecules_here), calculated, standardized, desired_delta)
         
         
         # Similarity Based Fitness _________
-        writer.add_scalar('Mean Similarty',        Similarity_calculated.mean(), generation_index) # Mean similarity
-        writer.add_scalar('Max  Similarty',        max(Similarity_calculated),   generation_index) # Max similarity
-        
-        Similarity_calculated = np.array([0 if x > desired_delta else -10**6 for x in Similarity_calculated])
-        Similarity_calculated = Similarity_calculated.reshape((fitness.shape[0], 1))
-
-        fitness = fitness + Similarity_calculated
+        if 'SIMILR' in calculated:
+            writer.add_scalar('Mean Similarty',        calculated['SIMILR'].mean(), generation_index) # Mean similarity
+            writer.add_scalar('Max  Similarty',        max(calculated['SIMILR']),   generation_index) # Max similarity
         
         
         # Plot fitness without discriminator 
@@ -253,14 +555,9 @@ def fitness(molecules_here,    properties_calc_ls,
         save_curve.append(max(fitness))
         writer.add_scalar('avg fitness without discr',  fitness.mean(),   generation_index)
         
-        # max fitness without discriminator
-        f = open('{}/max_fitness_no_discr.txt'.format(data_dir), 'a+')
-        f.write(str(max(fitness)[0]) + '\n')
-        f.close()
-        # avg fitness without discriminator
-        f = open('{}/avg_fitness_no_discr.txt'.format(data_dir), 'a+')
-        f.write(str(fitness.mean()) + '\n')
-        f.close()
+        # max & avg fitness without discriminator
+        write_stat(data_dir, generation_index, 'max_fitness_no_discr', max(fitness)[0], results_store)
+        write_stat(data_dir, generation_index, 'avg_fitness_no_discr', fitness.mean(),  results_store)
         
         
 #        fitness = (beta * discriminator_predictions) + fitness
@@ -269,134 +566,62 @@ def fitness(molecules_here,    properties_calc_ls,
         writer.add_scalar('max fitness with discrm',  max(fitness),     generation_index)   
         writer.add_scalar('avg fitness with discrm',  fitness.mean(),   generation_index)   
 
-        # max fitness with discriminator
-        f = open('{}/max_fitness_discr.txt'.format(data_dir), 'a+')
-        f.write(str(max(fitness)[0]) + '\n')
-        f.close()
-        # avg fitness with discriminator
-        f = open('{}/avg_fitness_discr.txt'.format(data_dir), 'a+')
-        f.write(str(fitness.mean()) + '\n')
-        f.close()
+        # max & avg fitness with discriminator
+        write_stat(data_dir, generation_index, 'max_fitness_discr', max(fitness)[0], results_store)
+        write_stat(data_dir, generation_index, 'avg_fitness_discr', fitness.mean(),  results_store)
         
         
-        # Plot properties 
-        writer.add_scalar('non standr max logp',   max(logP_calculated),         generation_index) # logP plots      
-        writer.add_scalar('non standr mean logp',  logP_calculated.mean(),       generation_index)                    
-        writer.add_scalar('non standr min sas',    min(SAS_calculated),          generation_index) # SAS plots  
-        writer.add_scalar('non standr mean sas',   SAS_calculated.mean(),        generation_index)
-        writer.add_scalar('non standr min ringp',  min(RingP_calculated),        generation_index) # RingP plots
-        writer.add_scalar('non standr mean ringp', RingP_calculated.mean(),      generation_index)
-        writer.add_scalar('non standr max USRCAT Similarity', max(USRSim_calculated), generation_index) # USRCAT Similarity plots             #!#
-        writer.add_scalar('non standr mean USRCAT Similarity', USRSim_calculated.mean(), generation_index)
-        writer.add_scalar('non standr max Tanimoto Similarity', max(TaniSim_calculated), generation_index) # Tanimoto Similarity plots        #!#
-        writer.add_scalar('non standr mean Tanimoto Similarity', TaniSim_calculated.mean(), generation_index)
-
-
-        # max logP - non standardized
-        f = open('{}/max_logp.txt'.format(data_dir), 'a+')
-        f.write(str(max(logP_calculated)) + '\n')
-        f.close()
-        # mean logP - non standardized
-        f = open('{}/avg_logp.txt'.format(data_dir), 'a+')
-        f.write(str(logP_calculated.mean()) + '\n')
-        f.close()
-        # min SAS - non standardized 
-        f = open('{}/min_SAS.txt'.format(data_dir), 'a+')
-        f.write(str(min(SAS_calculated)) + '\n')
-        f.close()
-        # mean SAS - non standardized 
-        f = open('{}/avg_SAS.txt'.format(data_dir), 'a+')
-        f.write(str(SAS_calculated.mean()) + '\n')
-        f.close()
-        # min RingP - non standardized 
-        f = open('{}/min_RingP.txt'.format(data_dir), 'a+')
-        f.write(str(min(RingP_calculated)) + '\n')
-        f.close()
-        # mean RingP - non standardized 
-        f = open('{}/avg_RingP.txt'.format(data_dir), 'a+')
-        f.write(str(RingP_calculated.mean()) + '\n')
-        f.close()        
-        # max USRCAT Similarity - non standardised                             #!#
-        f = open('{}/max_Similarity.txt'.format(data_dir), 'a+')
-        f.write(str(max(USRSim_calculated)) + '\n')
-        f.close()
-        # mean USRCAT Similarity - non standardized                            #!#
-        f = open('{}/avg_Similarity.txt'.format(data_dir), 'a+')
-        f.write(str(USRSim_calculated.mean()) + '\n')
-        f.close()
-        # max Tanimoto Similarity - non standardised                           #!#
-        f = open('{}/max_Tanimoto.txt'.format(data_dir), 'a+')
-        f.write(str(max(TaniSim_calculated)) + '\n')
-        f.close()
-        # mean Tanimoto Similarity - non standardized                          #!#
-        f = open('{}/avg_Tanimoto.txt'.format(data_dir), 'a+')
-        f.write(str(TaniSim_calculated.mean()) + '\n')
-        f.close()
+        # Plot properties, and write their statistics (non standardized)
+        for spec in specs:
+            if spec.log_name is None:
+                continue
+            best_stat = np.nanmax if spec.best == 'max' else np.nanmin
+            best      = nan_stat(best_stat,  calculated[spec.name])
+            mean      = nan_stat(np.nanmean, calculated[spec.name])
+            writer.add_scalar('non standr {} {}'.format(spec.best, spec.log_name), best, generation_index)
+            writer.add_scalar('non standr mean {}'.format(spec.log_name),          mean, generation_index)
+            if spec.file_name is None:
+                continue
+            write_stat(data_dir, generation_index, '{}_{}'.format(spec.best, spec.file_name), best, results_store)
+            write_stat(data_dir, generation_index, 'avg_{}'.format(spec.file_name),           mean, results_store)
         
-    return fitness, logP_calculated, SAS_calculated, RingP_calculated, USRSim_calculated, TaniSim_calculated 
+    return fitness, calculated
 
 
-def obtained_standardized_properties(molecules_here,  logP_results, SAS_results, ringP_results, similar_results, USRSim_results, TaniSim_results):     #!#
+def obtained_standardized_properties(molecules_here, cached_results, properties_calc_ls):
     ''' Obtain calculated properties of molecules in molecules_here, and standardize
-    values base on properties of the Zinc Data set. 
-    '''
-    logP_calculated       = []
-    SAS_calculated        = []
-    RingP_calculated      = []
-    Similarity_calculated = []
-    USRSim_calculated     = [] #!#
-    TaniSim_calculated    = [] #!#
-
-    for smi in molecules_here:
-        logP_calculated.append(logP_results[smi])
-        SAS_calculated.append(SAS_results[smi])
-        RingP_calculated.append(ringP_results[smi])
-        Similarity_calculated.append(similar_results[smi])
-        USRSim_calculated.append(USRSim_results[smi])               #!#
-        TaniSim_calculated.append(TaniSim_results[smi])             #!#
-    logP_calculated  = np.array(logP_calculated)
-    SAS_calculated   = np.array(SAS_calculated)
-    RingP_calculated = np.array(RingP_calculated)
-    Similarity_calculated = np.array(Similarity_calculated)
-    USRSim_calculated = np.array(USRSim_calculated)         #!#
-    TaniSim_calculated = np.array(TaniSim_calculated)       #!#
+    values base on properties of the Zinc Data set (see PropertySpec.norm). Properties 
+    that were not calculated for a molecule are NaN.
 
-    
-    # Standardize logP based on zinc logP (mean: 2.4729421499641497 & std : 1.4157879815362406)
-    logP_norm = (logP_calculated - 2.4729421499641497) / 1.4157879815362406
-    logP_norm = logP_norm.reshape((logP_calculated.shape[0], 1))  
-    
-    # Standardize SAS based on zinc SAS(mean: 3.0470797085649894    & std: 0.830643172314514)
-    SAS_norm = (SAS_calculated - 3.0470797085649894) / 0.830643172314514
-    SAS_norm = SAS_norm.reshape((SAS_calculated.shape[0], 1))  
-    
-    # Standardiize RingP based on zinc RingP(mean: 0.038131530820234766 & std: 0.2240274735210179)
-    RingP_norm = (RingP_calculated - 0.038131530820234766) / 0.2240274735210179
-    RingP_norm = RingP_norm.reshape((RingP_calculated.shape[0], 1))
-
-    # Standardize USRCAT Similarity based on zinc ChemBL Similarity(mean: 3.053230897406870 & std: 0.834794987448313)                #!#     
-    USRSim_norm = (USRSim_calculated - 0.186428542) / 0.035664915
-    USRSim_norm = USRSim_norm.reshape((USRSim_calculated.shape[0], 1))                                                               #!#
-    
-    # Standardize Tanimoto Similarity based on ChemBL Tanimoto Similarity(mean: 0.350252265668509 & std: 0.0681108949632873)         #!#     
-    TaniSim_norm = (TaniSim_calculated - 0.350252265668509) / 0.0681108949632873
-    TaniSim_norm = TaniSim_norm.reshape((TaniSim_calculated.shape[0], 1))                                                            #!#
-    
-    return logP_calculated, SAS_calculated, RingP_calculated, logP_norm, SAS_norm, RingP_norm, Similarity_calculated, USRSim_calculated, USRSim_norm, TaniSim_calculated, TaniSim_norm
+    Returns:
+    calculated   (dict) : {property_name: np.array of values, shape (len(molecules_here), )}
+    standardized (dict) : {property_name: np.array of standardized values, shape (len(molecules_here), 1)}
+    '''
+    calculated   = OrderedDict()
+    standardized = OrderedDict()
+    for spec in get_property_specs(properties_calc_ls):
+        results                 = cached_results.get(spec.name, {})
+        calculated[spec.name]   = np.array([results.get(smi, np.nan) for smi in molecules_here], dtype=np.float64)
+        standardized[spec.name] = spec.standardize(calculated[spec.name]).reshape((len(molecules_here), 1))
+    return calculated, standardized
         
 
 def obtain_fitness(disc_enc_type, smiles_here, selfies_here, properties_calc_ls, 
-                   discriminator, generation_index, max_molecules_len, device, generation_size, num_processors, writer, beta, image_dir, data_dir, starting_smile, desired_delta, save_curve):
+                   discriminator, generation_index, max_molecules_len, device, generation_size, num_processors, writer, beta, image_dir, data_dir, starting_smile, desired_delta, save_curve,
+                   property_cache=None, worker_pool=None, diagnostic_settings=None, results_store=None, diagnostic_rng=None):
     ''' Obtain fitness of generation based on choices of disc_enc_type.
         Essentially just calls 'fitness'
+
+    If results_store (see results_store.py) is given, the molecules of the generation, with
+    their fitness and all properties, are recorded there instead of in text files.
     '''
-    # ANALYSE THE GENERATION                        #!#
+    # ANALYSE THE GENERATION
     if disc_enc_type == 'smiles' or disc_enc_type == 'properties_rdkit':
-        fitness_here, logP_calculated, SAS_calculated, RingP_calculated, USRSim_calculated, TaniSim_calculated = fitness(smiles_here,   properties_calc_ls ,   discriminator, 
-                                                                           disc_enc_type, generation_index,   max_molecules_len, device, num_processors, writer, beta, data_dir, starting_smile, desired_delta, save_curve) 
+        fitness_here, calculated = fitness(smiles_here,   properties_calc_ls ,   discriminator, 
+                                           disc_enc_type, generation_index,   max_molecules_len, device, num_processors, writer, beta, data_dir, starting_smile, desired_delta, save_curve, property_cache, worker_pool, diagnostic_settings, results_store, diagnostic_rng) 
     elif disc_enc_type == 'selfies':
-        fitness_here, logP_calculated, SAS_calculated, RingP_calculated, USRSim_calculated, TaniSim_calculated = fitness(selfies_here,  properties_calc_ls ,   discriminator, 
-                                                                           disc_enc_type, generation_index,   max_molecules_len, device, num_processors, writer, beta, data_dir, starting_smile, desired_delta, save_curve) 
+        fitness_here, calculated = fitness([selfies_tokens.detokenize(tokens) for tokens in selfies_here],  properties_calc_ls ,   discriminator, 
+                                           disc_enc_type, generation_index,   max_molecules_len, device, num_processors, writer, beta, data_dir, starting_smile, desired_delta, save_curve, property_cache, worker_pool, diagnostic_settings, results_store, diagnostic_rng) 
         
 
 
@@ -404,66 +629,51 @@ def obtain_fitness(disc_enc_type, smiles_here, selfies_here, properties_calc_ls,
     order, fitness_ordered, smiles_ordered, selfies_ordered = order_based_on_fitness(fitness_here, smiles_here, selfies_here)    
 
     # Order molecules based on ordering of 'smiles_ordered'
-    logP_calculated  = [logP_calculated[idx] for idx in order]
-    SAS_calculated   = [SAS_calculated[idx] for idx in order]
-    RingP_calculated = [RingP_calculated[idx] for idx in order]
-    USRSim_calculated = [USRSim_calculated[idx] for idx in order]                       #!#
-    TaniSim_calculated = [TaniSim_calculated[idx] for idx in order]                     #!#
+    reported           = [spec for spec in get_property_specs(properties_calc_ls) if spec.ordered_file is not None]
+    properties_ordered = OrderedDict((spec.name, [calculated[spec.name][idx] for idx in order]) for spec in reported)
     
-    os.makedirs('{}/{}'.format(data_dir, generation_index))
-    #  Write ordered smiles in a text file
-    f = open('{}/{}/smiles_ordered.txt'.format(data_dir, generation_index), 'a+')
-    f.writelines(["%s\n" % item  for item in smiles_ordered])
-    f.close()
-    #  Write logP of ordered smiles in a text file
-    f = open('{}/{}/logP_ordered.txt'.format(data_dir, generation_index), 'a+')
-    f.writelines(["%s\n" % item  for item in logP_calculated])
-    f.close()
-    #  Write sas of ordered smiles in a text file
-    f = open('{}/{}/sas_ordered.txt'.format(data_dir, generation_index), 'a+')
-    f.writelines(["%s\n" % item  for item in SAS_calculated])
-    f.close()
-    #  Write ringP of ordered smiles in a text file
-    f = open('{}/{}/ringP_ordered.txt'.format(data_dir, generation_index), 'a+')
-    f.writelines(["%s\n" % item  for item in RingP_calculated])
-    f.close()
-    #  Write USRCAT Similarity of ordered smiles in a text file                                        #!#
-    f = open('{}/{}/USRCATSimilarity_ordered.txt'.format(data_dir, generation_index), 'a+')
-    f.writelines(["%s\n" % item  for item in USRSim_calculated])
-    f.close()
-    #  Write Tanimoto Similarity of ordered smiles in a text file                                      #!#
-    f = open('{}/{}/Tanimoto_ordered.txt'.format(data_dir, generation_index), 'a+')
-    f.writelines(["%s\n" % item  for item in TaniSim_calculated])
-    f.close()
+    if results_store is not None:
+        results_store.add_molecules(generation_index, smiles_ordered, fitness_ordered, 
+                                    {name: values[order] for name, values in calculated.items()})
+    else:
+        os.makedirs('{}/{}'.format(data_dir, generation_index))
+        #  Write ordered smiles in a text file
+        f = open('{}/{}/smiles_ordered.txt'.format(data_dir, generation_index), 'a+')
+        f.writelines(["%s\n" % item  for item in smiles_ordered])
+        f.close()
+        #  Write each property of ordered smiles in a text file (eg. 'logP_ordered.txt')
+        for spec in reported:
+            f = open('{}/{}/{}.txt'.format(data_dir, generation_index, spec.ordered_file), 'a+')
+            f.writelines(["%s\n" % item  for item in properties_ordered[spec.name]])
+            f.close()
 
 
     #print statement for the best molecule in the generation
     print('Best best molecule in generation ', generation_index)
     print('    smile  : ', smiles_ordered[0])
     print('    fitness: ', fitness_ordered[0])
-    print('    logP   : ', logP_calculated[0])
-    print('    sas    : ', SAS_calculated[0])
-    print('    ringP  : ', RingP_calculated[0])
-    print('    USRCAT : ', USRSim_calculated[0])                               #!#
-    print('    Tanimoto : ', TaniSim_calculated[0])                            #!#                                                                                      #!#  --> Another Similarity change to the right and two lines down |
-                                                                                                                                                                        #!#                                                                V 
+    for spec in reported:
+        print('    {:7s}: '.format(spec.label), properties_ordered[spec.name][0])
     
-    f = open('{}/best_in_generations.txt'.format(data_dir), 'a+')
-    best_gen_str = 'index: {},  smile: {}, fitness: {}, logP: {}, sas: {}, ringP: {}, USRCAT: {}, Tanimoto: {}'.format(generation_index, smiles_ordered[0], fitness_ordered[0], logP_calculated[0], SAS_calculated[0], RingP_calculated[0], USRSim_calculated[0], TaniSim_calculated[0])
-    f.write(best_gen_str + '\n')
-    f.close()
-                                                                                                            #!# -->
-    show_generation_image(generation_index, image_dir, smiles_ordered, fitness_ordered, logP_calculated, SAS_calculated, RingP_calculated, USRSim_calculated, TaniSim_calculated)    
+    if results_store is None:
+        f = open('{}/best_in_generations.txt'.format(data_dir), 'a+')
+        best_gen_str = 'index: {},  smile: {}, fitness: {}'.format(generation_index, smiles_ordered[0], fitness_ordered[0])
+        best_gen_str = best_gen_str + ''.join([', {}: {}'.format(spec.label, properties_ordered[spec.name][0]) for spec in reported])
+        f.write(best_gen_str + '\n')
+        f.close()
+
+    show_generation_image(generation_index, image_dir, smiles_ordered, fitness_ordered, list(properties_ordered.values()))
         
     return fitness_here, order, fitness_ordered, smiles_ordered, selfies_ordered
 
 
-def show_generation_image(generation_index, image_dir, smiles_ordered, fitness, logP, SAS, RingCount, USRSim, TaniSim):  #!#
+def show_generation_image(generation_index, image_dir, smiles_ordered, fitness, properties):
     ''' Plot 100 molecules with the best fitness in in a generation 
         Called after at the end of each generation. Image in each generation
         is stored with name 'generation_index.png'
     
-    Images are stored in diretory './images'
+    Images are stored in diretory './images'. Each molecule is labelled with its fitness,
+    followed by the values in properties (list of lists, in the order of smiles_ordered)
     '''
     if generation_index > 1:
         A = list(smiles_ordered) 
@@ -471,18 +681,24 @@ def show_generation_image(generation_index, image_dir, smiles_ordered, fitness,
         if len(A) < 100 : return #raise Exception('Not enough molecules provided for plotting ', len(A))
         A = [Chem.MolFromSmiles(x) for x in A]
         
-        evo.create_100_mol_image(A, "./{}/{}_ga.png".format(image_dir, generation_index), fitness, logP, SAS, RingCount, USRSim, TaniSim)    #!#
+        evo.create_100_mol_image(A, "./{}/{}_ga.png".format(image_dir, generation_index), fitness, properties)
 
 
 def obtain_previous_gen_mol(starting_smiles,  starting_selfies, generation_size,
-                            generation_index, selfies_all,      smiles_all):
+                            generation_index, history, rng=None):
     '''Obtain molecules from one generation prior.
        If generation_index is 1, only the the starting molecules are returned 
        
      Parameters:
+     starting_smiles  (list)              : Starting molecules (SMILES)
+     starting_selfies (list)              : Starting molecules (SELFIE token ids)
+     generation_size  (int)               : Number of molecules in a generation
+     generation_index (int)               : Index of the generation
+     history          (PopulationHistory) : Populations of the run (see population_history.py)
+     rng              (np.random.Generator) : Random choice of the starting molecules (None: the global random state)
          
      Returns: 
-    
+     (list, list) : SMILES & SELFIE token ids of the population
     '''
     # Obtain molecules from the previous generation 
     
@@ -493,13 +709,13 @@ def obtain_previous_gen_mol(starting_smiles,  starting_selfies, generation_size,
         randomized_selfies = []
         for i in range(generation_size): # nothing to obtain from previous gen
                                          # So, choose random moleclues from the starting list 
-            index = randrange(len(starting_smiles))
+            index = randrange(len(starting_smiles)) if rng is None else int(rng.integers(len(starting_smiles)))
             randomized_smiles.append(starting_smiles[index])
             randomized_selfies.append(starting_selfies[index])
 
         return randomized_smiles, randomized_selfies
     else:
-        return smiles_all[generation_index-2], selfies_all[generation_index-2]
+        return history.last()
     
 
 
@@ -514,77 +730,131 @@ def order_based_on_fitness(fitness_here, smiles_here, selfies_here):
     return order, fitness_ordered, smiles_ordered, selfies_ordered
 
 
-def apply_generation_cutoff(order, generation_size):
+def apply_generation_cutoff(order, generation_size, fitness_ordered=None, selection_settings=None, rng=None):
     ''' Return of a list of indices of molecules that are kept (high fitness)
         and a list of indices of molecules that are replaced   (low fitness)
         
-    The cut-off is imposed using a Fermi-Function
+    By default the cut-off is imposed using a Fermi-Function; other schemes can be chosen
+    with selection_settings (see selection.py)
         
     Parameters:
-    order (list)          : list of molecule indices arranged in Decreasing order of fitness
-    generation_size (int) : number of molecules in a generation
+    order (list)               : list of molecule indices arranged in Decreasing order of fitness
+    generation_size (int)      : number of molecules in a generation
+    fitness_ordered (list)     : fitness of the molecules, in Decreasing order (None: only the order is used)
+    selection_settings (dict)  : Overrides of selection.default_selection_settings
+    rng (np.random.Generator)  : Random numbers of the selection (None: the global np.random state)
     
     Returns:
-    to_replace (list): indices of molecules that will be replaced by random mutations of 
-                       molecules in list 'to_keep'
-    to_keep    (list): indices of molecules that will be kept for the following generations
+    to_replace (np.array): indices of molecules that will be replaced by random mutations of 
+                           molecules in list 'to_keep'
+    to_keep    (np.array): indices of molecules that will be kept for the following generations
     '''
-    # Get the probabilities that a molecule with a given fitness will be replaced
-    # a fermi function is used to smoothen the transition
-    positions     = np.array(range(0, len(order))) - 0.2*float(len(order))
-    probabilities = 1.0 / (1.0 + np.exp(-0.02 * generation_size * positions / float(len(order))))        
-    
-    to_replace = [] # all molecules that are replaced 
-    to_keep    = [] # all molecules that are kept 
-    for idx in range(0,len(order)):
-        if np.random.rand(1) < probabilities[idx]:
-            to_replace.append(idx)
-        else:
-            to_keep.append(idx)
+    if fitness_ordered is None:
+        fitness_ordered = -np.arange(len(order))
+    keep = selection.select_survivors(fitness_ordered, generation_size, selection_settings, rng)
+    return np.flatnonzero(~keep), np.flatnonzero(keep)
+
+
+def mutate_batch(task):
+    '''Mutate the parents of a batch of replaced molecules in a worker process (see 'obtain_next_gen_molecules')
+
+    Parameters:
+    task (tuple) : (list of (slot, token ids of the parent), max_molecules_len, selfies_tokens.selfies_alphabet 
+                    of the parent process, run_seed, generation_index, descriptor of the novelty filter (or None), max_rerolls)
+
+    Returns:
+    (list) : (slot, token ids of the mutated molecule, smile) for each slot of the batch
+    '''
+    slots, max_molecules_len, alphabet, run_seed, generation_index, filter_descriptor, max_rerolls = task
+    selfies_tokens.add_tokens(alphabet)     # same token ids as the parent process
+    seen    = None if filter_descriptor is None else BloomFilter.attach(filter_descriptor)
+    mutated = []
+    try:
+        for slot, tokens in slots:
+            rng = selection.get_rng(run_seed, generation_index, 'mutation', slot)
+            tokens_new, smiles_new = evo.mutate_tokens(tokens, max_molecules_len, rng=rng, seen=seen, max_rerolls=max_rerolls)
+            mutated.append((slot, tokens_new, smiles_new))
+    finally:
+        if seen is not None:
+            seen.close()
+    return mutated
 
-    return to_replace, to_keep
 
-    
 def obtain_next_gen_molecules(order,           to_replace,     to_keep, 
-                              selfies_ordered, smiles_ordered, max_molecules_len):
+                              selfies_ordered, smiles_ordered, max_molecules_len,
+                              worker_pool=None, num_processors=1, run_seed=None, generation_index=0,
+                              novelty_filter=None, max_rerolls=10):
     ''' Obtain the next generation of molecules. Bad molecules are replaced by 
     mutations of good molecules 
+
+    If run_seed is given, the parents are chosen with the 'parents' random stream of the generation,
+    and every replaced molecule (slot) is mutated with its own random stream (see selection.get_rng).
+    The mutations are done in batches by the processes of worker_pool (if given); results only depend 
+    on run_seed, not on the number of processes. Otherwise the molecules are mutated here, with the 
+    global np.random state.
+
+    If novelty_filter is given, mutations that are (probably) in it, ie. that were evaluated before,
+    are re-rolled (at most max_rerolls times per molecule).
     
     Parameters:
     order (list)            : list of molecule indices arranged in Decreasing order of fitness
     to_replace (list)       : list of indices of molecules to be replaced by random mutations of better molecules
     to_keep (list)          : list of indices of molecules to be kept in following generation
-    selfies_ordered (list)  : list of SELFIE molecules, ordered by fitness 
+    selfies_ordered (list)  : list of SELFIE molecules (token ids, see selfies_tokens.py), ordered by fitness 
     smiles_ordered (list)   : list of SMILE molecules, ordered by fitness 
     max_molecules_len (int) : length of largest molecule 
+    worker_pool (Pool)      : Worker processes created by 'create_worker_pool' (optional)
+    num_processors (int)    : Number of processes of worker_pool
+    run_seed (int)          : Seed of the run (see selection.get_rng)
+    generation_index (int)  : Index of the generation
+    novelty_filter (BloomFilter) : Molecules seen in the run (see novelty_filter.py; optional)
+    max_rerolls (int)       : Max. number of seen mutations re-rolled per molecule
     
     Returns:
     smiles_mutated (list): next generation of mutated molecules as SMILES
-    selfies_mutated(list): next generation of mutated molecules as SELFIES
+    selfies_mutated(list): next generation of mutated molecules as SELFIE token ids
     '''
-    smiles_mutated = []
-    selfies_mutated = []
-    for idx in range(0,len(order)):
-        if idx in to_replace: # smiles to replace (by better molecules)
-            random_index=np.random.choice(to_keep, size=1, replace=True, p=None)[0]                             # select a random molecule that survived
-            grin_new, smiles_new = evo.mutations_random_grin(selfies_ordered[random_index], max_molecules_len)  # do the mutation
+    to_replace      = np.sort(np.asarray(to_replace, dtype=np.int64))
+    smiles_mutated  = list(smiles_ordered[:len(order)])
+    selfies_mutated = list(selfies_ordered[:len(order)])
+
+    # select a random molecule that survived, for every molecule that is replaced 
+    rng     = None if run_seed is None else selection.get_rng(run_seed, generation_index, 'parents')
+    parents = selection.choose_parents(to_keep, len(to_replace), rng)
+
+    if run_seed is None:
+        for idx, random_index in zip(to_replace, parents):
+            grin_new, smiles_new = evo.mutate_tokens(selfies_ordered[random_index], max_molecules_len, seen=novelty_filter, max_rerolls=max_rerolls)  # do the mutation
 
             # add mutated molecule to the population
-            smiles_mutated.append(smiles_new)
-            selfies_mutated.append(grin_new)
-        else: # smiles to keep
-            smiles_mutated.append(smiles_ordered[idx])
-            selfies_mutated.append(selfies_ordered[idx])
+            smiles_mutated[idx]  = smiles_new
+            selfies_mutated[idx] = grin_new
+        return smiles_mutated, selfies_mutated
+
+    slots      = [(int(idx), selfies_ordered[random_index]) for idx, random_index in zip(to_replace, parents)]
+    batch_size = max(1, int(np.ceil(len(slots) / (4.0 * num_processors))))
+    alphabet   = list(selfies_tokens.selfies_alphabet)
+    filter_descriptor = None if novelty_filter is None else novelty_filter.descriptor()
+    tasks      = [(slots[i:i+batch_size], max_molecules_len, alphabet, run_seed, generation_index, filter_descriptor, max_rerolls) 
+                  for i in range(0, len(slots), batch_size)]
+    if worker_pool is None:
+        mutated = map(mutate_batch, tasks)
+    else:
+        mutated = worker_pool.imap_unordered(mutate_batch, tasks, chunksize=1)
+    for batch in mutated:
+        for idx, grin_new, smiles_new in batch:
+            smiles_mutated[idx]  = smiles_new
+            selfies_mutated[idx] = grin_new
         
     return smiles_mutated, selfies_mutated
    
     
 
-def update_gen_res(smiles_all, smiles_mutated, selfies_all, selfies_mutated, smiles_all_counter):
-    '''Collect results that will be shared with global variables outside generations
+def update_gen_res(history, generation_index, smiles_mutated, selfies_mutated, smiles_all_counter):
+    '''Collect results that will be shared with global variables outside generations:
+       the mutated molecules become the population of generation generation_index (see population_history.py)
     '''
-    smiles_all.append(smiles_mutated)
-    selfies_all.append(selfies_mutated)
+    history.append(generation_index, smiles_mutated, selfies_mutated)
     
     for smi in smiles_mutated:
         if smi in smiles_all_counter:
@@ -592,7 +862,7 @@ def update_gen_res(smiles_all, smiles_mutated, selfies_all, selfies_mutated, smi
         else:
             smiles_all_counter[smi] = 1
     
-    return smiles_all, selfies_all, smiles_all_counter
+    return history, smiles_all_counter
 
 
 
@@ -0,0 +1,104 @@
+'''
+Novelty filter: a Bloom filter of all molecules evaluated in a run, queried by the mutation stage
+so that children that were already seen are mutated again instead of being re-evaluated.
+'''
+import math
+import hashlib
+import numpy as np
+
+from shared_arrays import SharedArray
+
+
+# capacity    : Expected number of molecules in a run (the false positive rate grows beyond it)
+# error_rate  : False positive rate at capacity (a new molecule is taken as seen, and re-rolled)
+# max_rerolls : Max. number of seen mutations re-rolled per child (the last one is accepted)
+default_novelty_settings = {'capacity': 1000000, 'error_rate': 0.01, 'max_rerolls': 10}
+
+
+def get_novelty_settings(novelty_settings=None):
+    '''Return 'default_novelty_settings', updated with novelty_settings (dict)
+    '''
+    settings = dict(default_novelty_settings)
+    settings.update(novelty_settings or {})
+    if int(settings['capacity']) < 1:
+        raise Exception('capacity must be at least 1, got: ', settings['capacity'])
+    if not 0 < settings['error_rate'] < 1:
+        raise Exception('error_rate must be in (0, 1), got: ', settings['error_rate'])
+    if int(settings['max_rerolls']) < 0:
+        raise Exception('max_rerolls must be at least 0, got: ', settings['max_rerolls'])
+    return settings
+
+
+def smiles_hash64(smi):
+    '''64-bit hash of a SMILE string (the same in every process, unlike hash())
+    '''
+    return int.from_bytes(hashlib.blake2b(smi.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class BloomFilter(object):
+    '''Bloom filter over the 64-bit hashes of canonical SMILES (see 'smiles_hash64').
+
+    The bits are kept in shared memory: the process that creates the filter owns it (adds
+    molecules, and calls 'unlink' when done), worker processes query it after attaching
+    with 'BloomFilter.attach(descriptor)'.
+
+    Parameters:
+    capacity   (int)   : Expected number of molecules
+    error_rate (float) : False positive rate when capacity molecules have been added
+    '''
+    def __init__(self, capacity=1000000, error_rate=0.01, _attach=None):
+        if _attach is None:
+            self.num_bits   = int(math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+            self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+            self.bits       = SharedArray(((self.num_bits + 7) // 8, ), np.uint8, fill=0)
+        else:
+            descriptor, self.num_bits, self.num_hashes = _attach
+            self.bits = SharedArray.attach(descriptor)
+        self.count = 0      # number of molecules added (by this process)
+
+    def descriptor(self):
+        '''Picklable description of the filter, sent to the workers
+        '''
+        return (self.bits.descriptor(), self.num_bits, self.num_hashes)
+
+    @classmethod
+    def attach(cls, descriptor):
+        return cls(_attach=descriptor)
+
+    def positions(self, smiles_ls):
+        '''Bit positions of the molecules in smiles_ls, shape (len(smiles_ls), num_hashes)
+           (double hashing of the two 32-bit halves of the hash)
+        '''
+        hashes = np.array([smiles_hash64(smi) for smi in smiles_ls], dtype=np.uint64)
+        first  = hashes & np.uint64(0xffffffff)
+        second = (hashes >> np.uint64(32)) | np.uint64(1)
+        steps  = np.arange(self.num_hashes, dtype=np.uint64)
+        return (first[:, None] + steps[None, :] * second[:, None]) % np.uint64(self.num_bits)
+
+    def add(self, smiles_ls):
+        '''Add the molecules (canonical SMILES) in smiles_ls
+        '''
+        if len(smiles_ls) == 0:
+            return
+        positions = self.positions(smiles_ls).reshape(-1)
+        np.bitwise_or.at(self.bits.array, (positions >> np.uint64(3)).astype(np.int64),
+                         np.left_shift(1, (positions & np.uint64(7)).astype(np.uint8)).astype(np.uint8))
+        self.count += len(smiles_ls)
+
+    def contains(self, smiles_ls):
+        '''Return a bool np.array, True for molecules of smiles_ls that were (probably) added before
+        '''
+        if len(smiles_ls) == 0:
+            return np.zeros(0, dtype=bool)
+        positions = self.positions(smiles_ls)
+        bits      = self.bits.array[(positions >> np.uint64(3)).astype(np.int64)] >> (positions & np.uint64(7)).astype(np.uint8)
+        return np.all(bits & 1, axis=1)
+
+    def __contains__(self, smi):
+        return bool(self.contains([smi])[0])
+
+    def close(self):
+        self.bits.close()
+
+    def unlink(self):
+        self.bits.unlink()
@@ -0,0 +1,82 @@
+'''
+History of the populations of a run. Only the live (latest) generation is kept in memory; older
+generations are appended to a compressed archive on disk, and can be read back with 'iter_history'.
+'''
+import gzip
+import json
+
+import selfies_tokens
+
+
+def write_generation(history_file, generation_index, smiles_ls, selfies_ls):
+    '''Append a generation to history_file. Every generation is a separate gzip member (one JSON
+       line), so that the file stays readable up to the last complete generation if a run is interrupted.
+    '''
+    record = {'generation': generation_index, 'smiles': list(smiles_ls),
+              'selfies': [selfies_tokens.detokenize(tokens) for tokens in selfies_ls]}
+    with gzip.open(history_file, 'at') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def iter_history(history_file):
+    '''Yield (generation index, list of SMILES, list of SELFIES) for every generation in history_file
+       (a generation that was only partly written, eg. by an interrupted run, is skipped)
+    '''
+    with gzip.open(history_file, 'rt') as f:
+        try:
+            for line in f:
+                record = json.loads(line)
+                yield record['generation'], record['smiles'], record['selfies']
+        except (EOFError, gzip.BadGzipFile):    # truncated in the data or in the header of a member
+            return
+
+
+class PopulationHistory(object):
+    '''Population of the live generation, and archive of the earlier ones.
+
+    Parameters:
+    history_file (string) : Archive of the earlier generations (gzip, see 'write_generation'); any
+                            existing file is replaced. None: earlier generations are not kept.
+    '''
+    def __init__(self, history_file=None):
+        self.history_file    = history_file
+        self.num_generations = 0
+        self._live           = None     # (generation index, smiles, selfies token ids)
+        self._archived       = False    # True once the live population is in history_file
+        if history_file is not None:
+            open(history_file, 'wb').close()
+
+    def __len__(self):
+        return self.num_generations
+
+    def append(self, generation_index, smiles_ls, selfies_ls):
+        '''Make (smiles_ls, selfies_ls) the live population (of generation generation_index),
+           archiving the previous one
+        '''
+        self.flush()
+        self._live     = (generation_index, list(smiles_ls), list(selfies_ls))
+        self._archived = False
+        self.num_generations += 1
+
+    def last(self):
+        '''Return (smiles, selfies token ids) of the live population
+        '''
+        if self._live is None:
+            raise Exception('No population recorded yet')
+        return self._live[1], self._live[2]
+
+    def flush(self):
+        '''Archive the live population (it stays in memory until the next 'append')
+        '''
+        if self._live is not None and self.history_file is not None and not self._archived:
+            write_generation(self.history_file, *self._live)
+            self._archived = True
+
+    def __iter__(self):
+        '''Yield (generation index, SMILES, SELFIES) of all archived generations and the live one
+        '''
+        if self.history_file is not None:
+            for generation in iter_history(self.history_file):
+                yield generation
+        if self._live is not None and not self._archived:
+            yield self._live[0], self._live[1], [selfies_tokens.detokenize(tokens) for tokens in self._live[2]]
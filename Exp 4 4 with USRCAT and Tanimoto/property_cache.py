@@ -0,0 +1,84 @@
+'''
+Run-scoped cache of calculated molecular properties, shared between generations
+'''
+from collections import OrderedDict
+
+
+class PropertyCache(object):
+    '''Least-recently-used cache of property values, keyed by canonical SMILES.
+
+    Most of a generation survives 'apply_generation_cutoff', so their properties
+    are looked up here instead of being sent to the worker processes again.
+    Molecules whose 3D embedding failed are remembered separately (negative cache),
+    so that an expensive USRCAT embedding is not re-attempted for them.
+
+    Parameters:
+    max_size   (int) : Maximum number of molecules with stored properties (0 disables the cache)
+    max_failed (int) : Maximum number of molecules kept in the negative cache
+    '''
+    def __init__(self, max_size=50000, max_failed=50000):
+        self.max_size   = max_size
+        self.max_failed = max_failed
+        self.hits       = 0
+        self.misses     = 0
+        self._entries   = OrderedDict()   # smile -> {property_name: value}
+        self._failed    = OrderedDict()   # smile -> None (molecules that failed to embed)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, smiles_ls, properties_calc_ls):
+        '''Split smiles_ls into molecules with all properties in the cache and molecules
+           that still need to be calculated.
+
+        Returns:
+        cached_results (dict) : {property_name: {smile: value}} for all cache hits
+        missing        (list) : smiles for which at least one property is not cached
+        '''
+        cached_results = {name: {} for name in properties_calc_ls}
+        missing        = []
+        for smi in smiles_ls:
+            entry = self._entries.get(smi)
+            if entry is None or any(name not in entry for name in properties_calc_ls):
+                self.misses += 1
+                missing.append(smi)
+                continue
+            self.hits += 1
+            self._entries.move_to_end(smi)
+            for name in properties_calc_ls:
+                cached_results[name][smi] = entry[name]
+        return cached_results, missing
+
+    def update(self, calculated_results):
+        '''Store freshly calculated properties ({property_name: {smile: value}})
+        '''
+        if self.max_size <= 0:
+            return
+        for name, results in calculated_results.items():
+            for smi, value in results.items():
+                entry = self._entries.get(smi)
+                if entry is None:
+                    entry = self._entries[smi] = {}
+                else:
+                    self._entries.move_to_end(smi)
+                entry[name] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def mark_failed(self, smiles_ls):
+        '''Record molecules for which a 3D embedding could not be obtained
+        '''
+        if self.max_failed <= 0:
+            return
+        for smi in smiles_ls:
+            self._failed[smi] = None
+            self._failed.move_to_end(smi)
+        while len(self._failed) > self.max_failed:
+            self._failed.popitem(last=False)
+
+    def is_failed(self, smi):
+        return smi in self._failed
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
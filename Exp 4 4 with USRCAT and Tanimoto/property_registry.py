@@ -0,0 +1,110 @@
+'''
+Registry of the molecular properties that can be requested in 'properties_calc_ls'
+'''
+import json
+from collections import OrderedDict
+
+
+# Roles of a property in 'fitness':
+#   objective  : part of the fitness (weight * standardized value)
+#   constraint : used to penalize molecules (see PropertySpec.penalty)
+#   diagnostic : only reported (tensorboard, text files, images); calculated for the molecules
+#                chosen by diagnostic_settings (see generation_props.select_diagnostic_molecules)
+property_roles = ['objective', 'constraint', 'diagnostic']
+
+# Cost classes of a property:
+#   cheap       : 2D descriptors, calculated from the mol object
+#   fingerprint : fingerprint similarities (usually calculated for a whole batch at once)
+#   embedding   : needs a 3D embedding of the molecule. Molecules that failed to embed are not
+#                 attempted again, and these properties are skipped for molecules that violate a constraint
+cost_classes = ['cheap', 'fingerprint', 'embedding']
+
+
+class PropertySpec(object):
+    '''Description of a property: how it is calculated, standardized, cached and reported.
+
+    Parameters:
+    name         (string)   : Name used in 'properties_calc_ls'
+    role         (string)   : One of 'property_roles'
+    compute      (function) : mol -> value (None if the calculation failed), called in a worker process
+    batch_compute(function) : list of mols -> list of values; used instead of compute if given
+    norm         (tuple)    : (mean, std) used to standardize the property (None: not standardized)
+    weight       (float)    : Weight of the standardized property in the fitness (role 'objective')
+    penalty      (function) : (np.array of values, desired_delta) -> np.array of penalties added to
+                              the fitness (role 'constraint')
+    cost         (string)   : One of 'cost_classes'
+    cacheable    (bool)     : False if values may not be reused in later generations (see PropertyCache)
+    label        (string)   : Short name used when printing the best molecule of a generation
+    log_name     (string)   : Name in tensorboard ('non standr max/mean <log_name>'); None: not logged
+    file_name    (string)   : Per-generation statistics are written to '<best>_<file_name>.txt' and 'avg_<file_name>.txt'
+    ordered_file (string)   : Values of the ordered generation are written to '<ordered_file>.txt'
+    best         (string)   : 'max' or 'min', the better end of the property (reported each generation)
+    '''
+    def __init__(self, name, role, compute=None, batch_compute=None, norm=None, weight=1.0, penalty=None,
+                 cost='cheap', cacheable=True, label=None, log_name=None, file_name=None, ordered_file=None, best='max'):
+        if role not in property_roles:
+            raise Exception('Invalid property role. Only possible choices are: ', property_roles)
+        if cost not in cost_classes:
+            raise Exception('Invalid property cost. Only possible choices are: ', cost_classes)
+        if compute is None and batch_compute is None:
+            raise Exception('No calculation given for property: ', name)
+        if role == 'constraint' and penalty is None:
+            raise Exception('No penalty given for constraint: ', name)
+        self.name          = name
+        self.role          = role
+        self.compute       = compute
+        self.batch_compute = batch_compute
+        self.norm          = norm
+        self.weight        = weight
+        self.penalty       = penalty
+        self.cost          = cost
+        self.cacheable     = cacheable
+        self.label         = label if label is not None else name
+        self.log_name      = log_name
+        self.file_name     = file_name
+        self.ordered_file  = ordered_file
+        self.best          = best
+
+    def standardize(self, values):
+        '''Standardize values with the (mean, std) of the property (unchanged if norm is None)
+        '''
+        if self.norm is None:
+            return values
+        return (values - self.norm[0]) / self.norm[1]
+
+
+# All known properties, in the order in which they are reported
+property_registry = OrderedDict()
+
+
+def register_property(spec):
+    '''Add a property (PropertySpec) to the registry, replacing any property with the same name.
+       Properties must be registered before the worker pool is created.
+    '''
+    property_registry[spec.name] = spec
+
+
+def load_norm_stats(stats_file):
+    '''Replace the (mean, std) of the registered properties with those in stats_file 
+       (written by build_norm_stats.py). Properties missing from the file are unchanged.
+
+    Returns:
+    (list) : Names of the properties whose normalization was updated
+    '''
+    with open(stats_file) as f:
+        stats = json.load(f)['properties']
+    updated = []
+    for name, item in stats.items():
+        if name in property_registry and property_registry[name].norm is not None and item['count'] > 0:
+            property_registry[name].norm = (item['mean'], item['std'])
+            updated.append(name)
+    return updated
+
+
+def get_property_specs(properties_calc_ls):
+    '''Return the PropertySpec of each name in properties_calc_ls (in registry order)
+    '''
+    unknown = [name for name in properties_calc_ls if name not in property_registry]
+    if len(unknown) > 0:
+        raise Exception('Unknown properties: ', unknown, ' Only possible choices are: ', list(property_registry))
+    return [spec for name, spec in property_registry.items() if name in properties_calc_ls]
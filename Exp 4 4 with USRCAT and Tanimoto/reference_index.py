@@ -0,0 +1,105 @@
+'''
+Hashed index of a reference data set of molecules (eg. ChemBL), for membership and novelty queries.
+
+The index is a sorted array of the 64-bit hashes (see novelty_filter.smiles_hash64) of the
+canonical SMILES of the data set, stored as a .npy file and memory-mapped when loaded, so that
+it takes next to no resident memory. A whole generation is looked up with a single np.searchsorted.
+Two different molecules share a hash with a probability of about n / 2**64 (negligible).
+'''
+import os
+import itertools
+import multiprocessing
+import numpy as np
+
+import evolution_functions as evo
+from novelty_filter import smiles_hash64
+
+
+def canonical_hashes(smiles_ls):
+    '''Hashes of the canonical form of the (valid) SMILES in smiles_ls (np.array of uint64)
+    '''
+    hashes = []
+    for smi in smiles_ls:
+        mol, smi_canon, did_convert = evo.sanitize_smiles(smi)
+        if did_convert and smi_canon != '':
+            hashes.append(smiles_hash64(smi_canon))
+    return np.array(hashes, dtype=np.uint64)
+
+
+def iter_smiles_chunks(filename, chunk_size):
+    '''Yield lists of (at most) chunk_size non-empty lines of filename
+    '''
+    chunk = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line != '':
+                chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def build_reference_index(smiles_file, index_file, num_processors=1, chunk_size=10000):
+    '''Build the index of the molecules in smiles_file (one SMILE per line), written to index_file (.npy)
+
+    Returns:
+    (int) : Number of unique molecules in the index
+    '''
+    chunks = iter_smiles_chunks(smiles_file, chunk_size)
+    hashes = [np.zeros(0, dtype=np.uint64)]
+    if num_processors > 1:
+        # At most 2*num_processors chunks are read ahead of the results (Pool.imap would queue the whole file)
+        with multiprocessing.Pool(num_processors) as pool:
+            window = [pool.apply_async(canonical_hashes, (chunk, )) for chunk in itertools.islice(chunks, 2*num_processors)]
+            while len(window) > 0:
+                hashes.append(window.pop(0).get())
+                window += [pool.apply_async(canonical_hashes, (chunk, )) for chunk in itertools.islice(chunks, 1)]
+    else:
+        hashes += [canonical_hashes(chunk) for chunk in chunks]
+    hashes = np.unique(np.concatenate(hashes))   # sorted
+    np.save(index_file + '.tmp.npy', hashes)
+    os.replace(index_file + '.tmp.npy', index_file)
+    return len(hashes)
+
+
+class ReferenceIndex(object):
+    '''Membership queries against an index built by 'build_reference_index'
+
+    Parameters:
+    index_file (string) : .npy file of the index (memory-mapped)
+    '''
+    def __init__(self, index_file):
+        self.hashes = np.load(index_file, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def contains(self, smiles_ls):
+        '''Return a bool np.array, True for the (canonical) SMILES of smiles_ls that are in the index
+        '''
+        if len(smiles_ls) == 0 or len(self.hashes) == 0:
+            return np.zeros(len(smiles_ls), dtype=bool)
+        hashes    = np.array([smiles_hash64(smi) for smi in smiles_ls], dtype=np.uint64)
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        return np.asarray(self.hashes[positions] == hashes)
+
+    def __contains__(self, smi):
+        return bool(self.contains([smi])[0])
+
+    def novelty(self, smiles_ls):
+        '''Fraction of the unique (canonical) SMILES of smiles_ls that are not in the index
+        '''
+        smiles_ls = list(set(smiles_ls))
+        if len(smiles_ls) == 0:
+            return 0.0
+        return float(1.0 - self.contains(smiles_ls).mean())
+
+
+if __name__ == '__main__':
+    num_molecules = build_reference_index(smiles_file    = './datasets/ChemBL_SMILES.txt',
+                                          index_file     = './datasets/ChemBL_index.npy',
+                                          num_processors = multiprocessing.cpu_count())
+    print('Molecules in the index: ', num_molecules)
@@ -0,0 +1,115 @@
+'''
+Reference molecule(s) for USRCAT & Tanimoto Similarity, prepared once per run and stored on disk
+'''
+import os
+import json
+import struct
+import numpy as np
+from rdkit import Chem
+from rdkit import DataStructs
+
+import usrcat
+
+
+default_reference_smile = 'C1(=NC(=NC2=C1N=C[N]2[H])N(C3=CC=C(C=C3)[S](=O)(=O)N([H])[H])[H])C4=CC(=CC=C4)C5=CC=CC=C5'
+
+# Files of a prepared reference set (in directory reference_dir)
+mols_file  = 'reference_mols.bin'   # RDKit binary mol blobs (with all conformers)
+data_file  = 'reference_data.npz'   # USRCAT descriptors of all conformers & Tanimoto fingerprints
+meta_file  = 'reference_meta.json'  # SMILES & settings used to prepare the set
+
+# USRCAT settings that change the reference conformers (see usrcat.default_settings); a prepared
+# set is reused only if all of them are unchanged
+embedding_settings = ['ref_num_confs', 'prune_rms', 'embed_tiers', 'time_budget', 'seed']
+
+
+def prepare_reference(reference_smiles, usrcat_settings, reference_dir):
+    '''Embed a conformer set of each reference molecule, and store the molecules,
+       their USRCAT descriptors and fingerprints in reference_dir.
+
+    A set prepared earlier with the same molecules and embedding settings (see 'embedding_settings') 
+    is reused as is.
+
+    Parameters:
+    reference_smiles (list)   : SMILE strings of the reference molecule(s)
+    usrcat_settings  (dict)   : Settings of the USRCAT calculation (see usrcat.default_settings);
+                                'ref_num_confs' conformers are embedded per reference molecule
+                                (seeded, if 'seed' is set)
+    reference_dir    (string) : Directory in which the reference set is stored
+    '''
+    settings = usrcat.get_settings(usrcat_settings)
+    meta     = {'smiles': list(reference_smiles), 'settings': {key: settings[key] for key in embedding_settings}}
+    if os.path.exists(os.path.join(reference_dir, meta_file)):
+        with open(os.path.join(reference_dir, meta_file)) as f:
+            if json.load(f) == meta:
+                return
+    if not os.path.exists(reference_dir):
+        os.makedirs(reference_dir)
+
+    mols, usrcat_ls, conf_ref, fps = [], [], [], []
+    for ref_idx, smi in enumerate(reference_smiles):
+        mol = Chem.MolFromSmiles(smi)
+        if mol is None:
+            raise Exception('Invalid reference smile: ', smi)
+        mol_3d, conf_ids, _ = usrcat.embed_conformers(mol, dict(settings, num_confs=settings['ref_num_confs']))
+        if len(conf_ids) == 0:
+            raise Exception('Failed to embed reference molecule: ', smi)
+        mols.append(mol_3d)
+        usrcat_ls.append(usrcat.get_usrcat_descriptors(mol_3d, conf_ids))
+        conf_ref += [ref_idx] * len(conf_ids)
+        fps.append(fingerprint_to_array(Chem.RDKFingerprint(mol)))
+
+    with open(os.path.join(reference_dir, mols_file), 'wb') as f:
+        for mol in mols:
+            blob = mol.ToBinary()
+            f.write(struct.pack('<I', len(blob)))
+            f.write(blob)
+    np.savez(os.path.join(reference_dir, data_file), usrcat=np.concatenate(usrcat_ls, axis=0),
+             conf_ref=np.array(conf_ref, dtype=np.int32), fps=np.array(fps))
+    with open(os.path.join(reference_dir, meta_file), 'w') as f:  # written last: marks a complete set
+        json.dump(meta, f)
+
+
+def load_reference(reference_dir):
+    '''Load a reference set stored by 'prepare_reference'
+
+    Returns:
+    (dict) : 'smiles'   : list of reference SMILES
+             'mols'     : list of rdkit mol objects (with conformers)
+             'usrcat'   : np.array (num. conformers, 60), USRCAT descriptors of all conformers
+             'conf_ref' : np.array (num. conformers, ), index of the reference of each conformer
+             'fps'      : list of RDKit fingerprints (ExplicitBitVect), one per reference
+    '''
+    with open(os.path.join(reference_dir, meta_file)) as f:
+        meta = json.load(f)
+    mols = []
+    with open(os.path.join(reference_dir, mols_file), 'rb') as f:
+        content = f.read()
+    offset = 0
+    while offset < len(content):
+        size,   = struct.unpack_from('<I', content, offset)
+        mols.append(Chem.Mol(content[offset+4: offset+4+size]))
+        offset += 4 + size
+    data = np.load(os.path.join(reference_dir, data_file))
+    return {'smiles':   meta['smiles'],
+            'mols':     mols,
+            'usrcat':   data['usrcat'],
+            'conf_ref': data['conf_ref'],
+            'fps':      [array_to_fingerprint(item) for item in data['fps']]}
+
+
+def fingerprint_to_array(fp):
+    '''Convert an RDKit ExplicitBitVect into a packed np.array of bits (uint8)
+    '''
+    bits = np.zeros((fp.GetNumBits(), ), dtype=np.uint8)
+    bits[list(fp.GetOnBits())] = 1
+    return np.packbits(bits)
+
+
+def array_to_fingerprint(packed):
+    '''Inverse of 'fingerprint_to_array'
+    '''
+    bits = np.unpackbits(packed)
+    fp   = DataStructs.ExplicitBitVect(len(bits))
+    fp.SetBitsFromList(np.flatnonzero(bits).tolist())
+    return fp
@@ -0,0 +1,170 @@
+'''
+Results of a run in a single SQLite database (WAL mode, append-only), written by a background thread:
+    molecules       : one row per molecule of every generation (rank, smile, fitness & all properties)
+    generations     : per-generation statistics, one row per (generation, name) (eg. 'max_fitness_no_discr')
+    embedding_tiers : the embedding strategy that succeeded for every newly embedded molecule
+    properties      : name, label & ordered file name of every property column
+
+The database can be read while the run is going on; 'export_text' writes the same text files as
+the original code (eg. 'avg_logp.txt', '<generation>/smiles_ordered.txt', 'best_in_generations.txt').
+'''
+import os
+import sys
+import queue
+import sqlite3
+import threading
+
+
+def quote(name):
+    '''SQL identifier of a property column'''
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def text_value(value):
+    '''Value as written in the text files (SQLite stores NaN as NULL)'''
+    return 'nan' if value is None else str(value)
+
+
+class ResultsStore(object):
+    '''Append-only store of the results of a run. Rows are queued by the calling thread, and
+       inserted in batches (one transaction per batch) by a background writer thread.
+
+    Parameters:
+    db_file    (string) : SQLite database (created if needed; an existing run is appended to)
+    specs      (list)   : PropertySpec of every property of the run (see property_registry.py)
+    batch_size (int)    : Max. number of queued writes per transaction
+    '''
+    def __init__(self, db_file, specs, batch_size=1000):
+        self.db_file    = db_file
+        self.columns    = [spec.name for spec in specs]
+        self.batch_size = batch_size
+        self._queue     = queue.Queue()
+        self._error     = None
+        self._thread    = threading.Thread(target=self._run, args=([(spec.name, spec.label, spec.ordered_file) for spec in specs], ), daemon=True)
+        self._thread.start()
+
+    def _run(self, properties):
+        try:
+            connection = sqlite3.connect(self.db_file)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, label TEXT, ordered_file TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS molecules (generation INTEGER, rank INTEGER, smiles TEXT, fitness REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS generations (generation INTEGER, name TEXT, value REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS embedding_tiers (generation INTEGER, smiles TEXT, tier TEXT)')
+            existing = [row[1] for row in connection.execute('PRAGMA table_info(molecules)')]
+            for name, label, ordered_file in properties:
+                if name not in existing:
+                    connection.execute('ALTER TABLE molecules ADD COLUMN {} REAL'.format(quote(name)))
+                connection.execute('INSERT OR REPLACE INTO properties VALUES (?, ?, ?)', (name, label, ordered_file))
+            connection.commit()
+
+            stop = False
+            while not stop:
+                items = [self._queue.get()]
+                while len(items) < self.batch_size:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for item in items:
+                    if item is None:
+                        stop = True
+                        continue
+                    sql, rows = item
+                    connection.executemany(sql, rows)
+                connection.commit()
+            connection.close()
+        except Exception as error:
+            self._error = error
+
+    def _put(self, sql, rows):
+        if self._error is not None:
+            raise Exception('Writing results failed: ', self._error)
+        self._queue.put((sql, rows))
+
+    def add_molecules(self, generation_index, smiles_ordered, fitness_ordered, properties_ordered):
+        '''Record the molecules of a generation, in decreasing order of fitness
+
+        Parameters:
+        properties_ordered (dict) : {property_name: list of values, in the order of smiles_ordered}
+        '''
+        names = [name for name in self.columns if name in properties_ordered]
+        sql   = 'INSERT INTO molecules (generation, rank, smiles, fitness{}) VALUES (?, ?, ?, ?{})'.format(
+                ''.join([', ' + quote(name) for name in names]), ', ?' * len(names))
+        rows  = [[generation_index, rank, smi, float(fitness_ordered[rank])] + [float(properties_ordered[name][rank]) for name in names]
+                 for rank, smi in enumerate(smiles_ordered)]
+        self._put(sql, rows)
+
+    def add_stat(self, generation_index, name, value):
+        '''Record a statistic of a generation (name: file name of the original text file, eg. 'avg_logp')
+        '''
+        self._put('INSERT INTO generations VALUES (?, ?, ?)', [(generation_index, name, float(value))])
+
+    def add_embedding_tiers(self, generation_index, tiers):
+        '''Record the embedding strategy of molecules (list of (smile, strategy name))
+        '''
+        self._put('INSERT INTO embedding_tiers VALUES (?, ?, ?)', [(generation_index, smi, tier) for smi, tier in tiers])
+
+    def close(self):
+        '''Write all queued results, and stop the writer thread
+        '''
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise Exception('Writing results failed: ', self._error)
+
+
+def export_text(db_file, data_dir):
+    '''Write the results in db_file as the text files of the original code, in data_dir
+       (existing files are replaced)
+    '''
+    connection = sqlite3.connect(db_file)
+    try:
+        properties = connection.execute('SELECT name, label, ordered_file FROM properties').fetchall()
+        columns    = [row[1] for row in connection.execute('PRAGMA table_info(molecules)')]
+        properties = [item for item in properties if item[0] in columns]    # (in registry order)
+        properties.sort(key=lambda item: columns.index(item[0]))
+        reported   = [item for item in properties if item[2] is not None]
+
+        # Statistics of each generation (eg. 'max_fitness_no_discr.txt', 'avg_logp.txt')
+        stats = {}
+        for name, value in connection.execute('SELECT name, value FROM generations ORDER BY generation, rowid'):
+            stats.setdefault(name, []).append(text_value(value))
+        for name, values in stats.items():
+            with open('{}/{}.txt'.format(data_dir, name), 'w') as f:
+                f.writelines([value + '\n' for value in values])
+
+        rows = connection.execute('SELECT generation, smiles, tier FROM embedding_tiers ORDER BY rowid').fetchall()
+        if len(rows) > 0 or len(stats) > 0:
+            with open('{}/embedding_tiers.txt'.format(data_dir), 'w') as f:
+                f.writelines(['{} {} {}\n'.format(*row) for row in rows])
+
+        # Ordered molecules & properties of each generation, and the best molecule of each generation
+        sql  = 'SELECT generation, smiles, fitness{} FROM molecules ORDER BY generation, rank'.format(''.join([', ' + quote(item[0]) for item in reported]))
+        best = []
+        generation, smiles_ordered, values_ordered = None, [], []
+        for row in list(connection.execute(sql)) + [(None, None, None)]:
+            if row[0] != generation:
+                if generation is not None:
+                    os.makedirs('{}/{}'.format(data_dir, generation), exist_ok=True)
+                    with open('{}/{}/smiles_ordered.txt'.format(data_dir, generation), 'w') as f:
+                        f.writelines(['%s\n' % item for item in smiles_ordered])
+                    for idx, item in enumerate(reported):
+                        with open('{}/{}/{}.txt'.format(data_dir, generation, item[2]), 'w') as f:
+                            f.writelines(['%s\n' % text_value(values[idx]) for values in values_ordered])
+                generation, smiles_ordered, values_ordered = row[0], [], []
+                if row[0] is not None:
+                    best.append('index: {},  smile: {}, fitness: {}'.format(row[0], row[1], text_value(row[2])) +
+                                ''.join([', {}: {}'.format(item[1], text_value(value)) for item, value in zip(reported, row[3:])]))
+            smiles_ordered.append(row[1])
+            values_ordered.append(row[3:])
+        if len(best) > 0:
+            with open('{}/best_in_generations.txt'.format(data_dir), 'w') as f:
+                f.writelines([line + '\n' for line in best])
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    export_text(db_file = sys.argv[1], data_dir = sys.argv[2])     # eg. python results_store.py ./results.db ./text_results
@@ -0,0 +1,93 @@
+'''
+Cost-aware scheduling of molecules over the worker pool
+'''
+import re
+import numpy as np
+
+
+# Tokens of a SMILE string that matter for the cost estimate: atoms (bracket atoms, the organic subset 
+# and its aromatic forms), ring closure labels and branches
+_cost_tokens = re.compile(r'\[[^\]]*\]|Br|Cl|[BCNOPSFI]|[bcnops]|%\d\d|\d|\(')
+
+
+def smiles_counts(smi):
+    '''Count the heavy atoms, rings and branches of a SMILE string, without parsing the molecule
+
+    Returns:
+    (int, int, int) : Number of heavy atoms, of ring closures (rings) and of branches
+    '''
+    num_heavy, num_closures, num_branches = 0, 0, 0
+    for token in _cost_tokens.findall(smi):
+        if token == '(':
+            num_branches += 1
+        elif token[0] == '%' or token.isdigit():
+            num_closures += 1
+        elif token.upper() != '[H]':
+            num_heavy += 1
+    return num_heavy, num_closures // 2, num_branches
+
+
+def estimate_cost(smiles_ls, embedding=True):
+    '''Estimate the relative cost of evaluating each molecule in smiles_ls.
+
+    The 3D embedding needed for USRCAT dominates: distance geometry scales roughly
+    with the square of the number of atoms, and every branch (a proxy of the rotatable 
+    bonds) and ring makes a successful embedding harder to find. Without embedding, the 
+    cost is simply proportional to the number of heavy atoms.
+
+    The counts are taken from the SMILE strings (see 'smiles_counts'): molecules are
+    only parsed by the workers that evaluate them.
+
+    Parameters:
+    smiles_ls (list) : SMILE strings of molecules
+    embedding (bool) : True if the molecules will be embedded in 3D (ie. USRSim is calculated)
+
+    Returns:
+    (np.array) : Relative cost of each molecule (float64)
+    '''
+    costs = np.ones((len(smiles_ls), ), dtype=np.float64)
+    for idx, smi in enumerate(smiles_ls):
+        num_heavy, num_rings, num_branches = smiles_counts(smi)
+        if not embedding:
+            costs[idx] = max(num_heavy, 1)
+            continue
+        costs[idx] = max(num_heavy, 1)**2 * (1.0 + 0.25*num_branches) * (1.0 + 0.5*num_rings)
+    return costs
+
+
+def make_batches(index_ls, costs, num_processors, batches_per_worker=4):
+    '''Split molecules into batches to be dispatched, in order, from a shared work queue.
+
+    Molecules are sorted longest-first. Each batch takes a share of the remaining cost
+    (remaining cost / (batches_per_worker * num_processors)), so the most expensive
+    molecules go out on their own at the start, and the end of the queue is made of
+    small batches of cheap molecules that keep all workers busy until the last one finishes.
+    Batches never fall below 1/8 of the first share, to bound the number of tasks.
+
+    Parameters:
+    index_ls           (np.array) : Indices of the molecules to be scheduled
+    costs              (np.array) : Estimated cost of each molecule in index_ls
+    num_processors     (int)      : Number of worker processes
+    batches_per_worker (int)      : Controls the size of batches (larger: smaller batches)
+
+    Returns:
+    batches (list) : List of np.arrays of molecule indices, most expensive first
+    '''
+    order     = np.argsort(-np.asarray(costs), kind='stable')
+    index_ls  = np.asarray(index_ls)[order]
+    costs     = np.asarray(costs, dtype=np.float64)[order]
+    remaining = np.cumsum(costs[::-1])[::-1]    # cost of molecules i, i+1, ...
+    cum_costs = np.cumsum(costs)
+    divisor   = float(batches_per_worker * num_processors)
+    min_cost  = remaining[0] / (8 * divisor) if len(costs) > 0 else 0.0
+
+    batches = []
+    start   = 0
+    while start < len(index_ls):
+        target = max(remaining[start] / divisor, min_cost)
+        done   = cum_costs[start] - costs[start]     # cost of all molecules before 'start'
+        stop   = int(np.searchsorted(cum_costs, done + target, side='right'))
+        stop   = min(max(stop, start + 1), len(index_ls))
+        batches.append(index_ls[start:stop])
+        start  = stop
+    return batches
@@ -0,0 +1,121 @@
+'''
+Selection of the molecules that survive a generation (the others are replaced by mutations of
+the survivors), and of the parents of the replaced molecules. All schemes work on whole arrays,
+so that the cost of the selection stays negligible for large generations.
+'''
+import numpy as np
+
+
+# Schemes of 'select_survivors':
+#   fermi      : molecules are replaced with a probability that increases with their rank (Fermi function, the original cut-off)
+#   truncation : the best keep_fraction of the generation survives
+#   tournament : the winners of round(keep_fraction * size) tournaments, between tournament_size random molecules each, survive
+selection_schemes          = ['fermi', 'truncation', 'tournament']
+default_selection_settings = {'scheme': 'fermi', 'keep_fraction': 0.2, 'tournament_size': 3}
+
+# Independent random streams of a generation (see 'get_rng')
+rng_streams = {'selection': 0, 'parents': 1, 'mutation': 2, 'diagnostics': 3, 'population': 4}
+
+
+def get_selection_settings(selection_settings=None):
+    '''Return 'default_selection_settings', updated with selection_settings (dict)
+    '''
+    settings = dict(default_selection_settings)
+    settings.update(selection_settings or {})
+    if settings['scheme'] not in selection_schemes:
+        raise Exception('Invalid selection scheme. Only possible choices are: ', selection_schemes)
+    if not 0 < settings['keep_fraction'] <= 1:
+        raise Exception('keep_fraction must be in (0, 1], got: ', settings['keep_fraction'])
+    if int(settings['tournament_size']) < 1:
+        raise Exception('tournament_size must be at least 1, got: ', settings['tournament_size'])
+    return settings
+
+
+def get_rng(run_seed, generation_index, stream, slot=None):
+    '''Return the np.random.Generator of a random stream (one of 'rng_streams') of a generation;
+       the 'mutation' stream has a Generator for every replaced molecule (slot)
+    '''
+    spawn_key = (generation_index, rng_streams[stream]) if slot is None else (generation_index, rng_streams[stream], int(slot))
+    return np.random.default_rng(np.random.SeedSequence(run_seed, spawn_key=spawn_key))
+
+
+def random_uniform(rng, size):
+    '''size random floats in [0, 1) from rng (None: the global np.random state)'''
+    return np.random.random(size) if rng is None else rng.random(size)
+
+
+def random_integers(rng, high, size):
+    '''size random integers in [0, high) from rng (None: the global np.random state)'''
+    return np.random.randint(high, size=size) if rng is None else rng.integers(high, size=size)
+
+
+def fermi_keep_mask(num_molecules, generation_size, rng=None):
+    '''Survivors of the original cut-off: the molecule at position i (in decreasing order of
+       fitness) is replaced with probability 1 / (1 + exp(-0.02 * generation_size * (i - 0.2*n) / n))
+
+    Returns:
+    (np.array) : bool, True for the positions that survive
+    '''
+    positions     = np.arange(num_molecules) - 0.2*float(num_molecules)
+    probabilities = 1.0 / (1.0 + np.exp(-0.02 * generation_size * positions / float(num_molecules)))
+    return random_uniform(rng, num_molecules) >= probabilities
+
+
+def truncation_keep_mask(fitness, keep_fraction):
+    '''Survivors of truncation selection: the round(keep_fraction * n) molecules of highest fitness
+    '''
+    num_keep = max(1, int(round(keep_fraction * len(fitness))))
+    keep     = np.zeros(len(fitness), dtype=bool)
+    if num_keep >= len(fitness):
+        keep[:] = True
+    else:
+        keep[np.argpartition(-fitness, num_keep - 1)[:num_keep]] = True
+    return keep
+
+
+def tournament_keep_mask(fitness, keep_fraction, tournament_size, rng=None):
+    '''Survivors of tournament selection: the winners of round(keep_fraction * n) tournaments,
+       each between tournament_size molecules drawn at random (with replacement)
+    '''
+    num_tournaments = max(1, int(round(keep_fraction * len(fitness))))
+    contestants     = random_integers(rng, len(fitness), (num_tournaments, int(tournament_size)))
+    winners         = contestants[np.arange(num_tournaments), np.argmax(fitness[contestants], axis=1)]
+    keep            = np.zeros(len(fitness), dtype=bool)
+    keep[winners]   = True
+    return keep
+
+
+def select_survivors(fitness, generation_size, selection_settings=None, rng=None):
+    '''Choose the molecules that survive a generation (at least the best one survives)
+
+    Parameters:
+    fitness            (np.array)            : Fitness of the molecules
+    generation_size    (int)                 : Number of molecules in a generation (used by scheme 'fermi')
+    selection_settings (dict)                : Overrides of 'default_selection_settings'
+    rng                (np.random.Generator) : Random numbers of the selection (None: the global np.random state)
+
+    Returns:
+    (np.array) : bool, True for the molecules that survive
+    '''
+    settings = get_selection_settings(selection_settings)
+    fitness  = np.asarray(fitness, dtype=np.float64)
+    if len(fitness) == 0:
+        return np.zeros(0, dtype=bool)
+    if settings['scheme'] == 'fermi':   # by rank: position in decreasing order of fitness
+        ranks = np.empty(len(fitness), dtype=np.int64)
+        ranks[np.argsort(-fitness, kind='stable')] = np.arange(len(fitness))
+        keep  = fermi_keep_mask(len(fitness), generation_size, rng)[ranks]
+    elif settings['scheme'] == 'truncation':
+        keep = truncation_keep_mask(fitness, settings['keep_fraction'])
+    else:
+        keep = tournament_keep_mask(fitness, settings['keep_fraction'], settings['tournament_size'], rng)
+    if not keep.any():
+        keep[np.argmax(fitness)] = True
+    return keep
+
+
+def choose_parents(keep_idx, num_children, rng=None):
+    '''Choose a parent (uniformly, with replacement) among the indices keep_idx for each of num_children molecules
+    '''
+    keep_idx = np.asarray(keep_idx)
+    return keep_idx[random_integers(rng, len(keep_idx), num_children)]
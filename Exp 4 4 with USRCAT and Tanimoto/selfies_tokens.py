@@ -0,0 +1,80 @@
+'''
+Compact representation of SELFIES for the population of the GA: a molecule is a byte string of
+uint8 token ids (one byte per SELFIE character, see 'selfies_alphabet'), so that mutation,
+deduplication and hashing work on short integer strings. SELFIE strings are only built at the
+boundaries (decoding to SMILES, the discriminator, output files).
+'''
+import re
+from functools import lru_cache
+import numpy as np
+
+
+_selfie_pattern = re.compile(r'\[[^\]]*\]')
+
+# Token ids: the SELFIE characters of the data sets (evolution_functions.smiles_alphabet, without the 
+# padding character 'X'), filled on first use (see 'init_alphabet'). Characters outside this alphabet 
+# (eg. of the starting molecules) are appended when first tokenized; ids never change within a run.
+selfies_alphabet = []
+token_ids        = {}
+
+
+def get_selfie_chars(selfie):
+    '''Obtain a list of all selfie characters in string selfie
+
+    Example:
+    >>> get_selfie_chars('[C][=C][C][=C][C][=C][Ring1][Branch1_1]')
+    ['[C]', '[=C]', '[C]', '[=C]', '[C]', '[=C]', '[Ring1]', '[Branch1_1]']
+    '''
+    return _selfie_pattern.findall(selfie)
+
+
+def init_alphabet():
+    '''Give the first token ids to the SELFIE characters of the data sets (once per process)
+    '''
+    if len(selfies_alphabet) > 0:
+        return
+    import evolution_functions as evo   # (not at the top: evolution_functions imports this module)
+    for char in evo.smiles_alphabet('selfies'):
+        if char != 'X' and char not in token_ids:
+            token_ids[char] = len(selfies_alphabet)
+            selfies_alphabet.append(char)
+
+
+def add_tokens(chars):
+    '''Give an id to all SELFIE characters in chars that are not in 'selfies_alphabet' yet
+    '''
+    init_alphabet()
+    for char in chars:
+        if char not in token_ids:
+            if len(selfies_alphabet) == 256:
+                raise Exception('Too many SELFIE characters for uint8 tokens, cannot add: ', char)
+            token_ids[char] = len(selfies_alphabet)
+            selfies_alphabet.append(char)
+
+
+@lru_cache(maxsize=2**16)
+def tokenize(selfie):
+    '''Convert a SELFIE string into token ids (memoized)
+
+    Parameters:
+    selfie (string) : SELFIE string of a molecule
+
+    Returns:
+    (bytes) : One uint8 token id per SELFIE character (see 'as_array')
+    '''
+    chars = _selfie_pattern.findall(selfie)
+    add_tokens(chars)
+    return bytes([token_ids[char] for char in chars])
+
+
+@lru_cache(maxsize=2**16)
+def detokenize(tokens):
+    '''Convert token ids (bytes) back into a SELFIE string (memoized)
+    '''
+    return ''.join([selfies_alphabet[idx] for idx in tokens])
+
+
+def as_array(tokens):
+    '''View token ids (bytes) as a np.array of uint8 (without copying)
+    '''
+    return np.frombuffer(tokens, dtype=np.uint8)
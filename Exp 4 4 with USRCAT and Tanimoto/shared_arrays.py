@@ -0,0 +1,78 @@
+'''
+Shared-memory arrays for passing molecules to, and results from, worker processes
+'''
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+
+def share_resource_tracker():
+    '''Start the resource tracker of this process, so that worker processes forked
+       afterwards register their shared memory with it, instead of starting their own
+       tracker (which would unlink blocks still in use when the worker exits).
+       Call before creating worker processes.
+    '''
+    resource_tracker.ensure_running()
+
+
+class SharedArray(object):
+    '''A NumPy array stored in a multiprocessing.shared_memory block.
+
+    The process that creates the array owns it (and calls 'unlink' when done);
+    worker processes attach to it by name with 'SharedArray.attach(descriptor)'
+    and read/write the same memory without any inter-process communication.
+
+    Parameters:
+    shape  (tuple) : Shape of the array
+    dtype  (dtype) : NumPy data type of the array
+    fill   (float) : Initial value of all elements (None: leave uninitialised)
+    '''
+    def __init__(self, shape, dtype, fill=None, _shm=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if _shm is None:
+            nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1) # zero sized blocks are not allowed
+            _shm   = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.shm   = _shm
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        if fill is not None:
+            self.array.fill(fill)
+
+    def descriptor(self):
+        '''Picklable description of the array, sent to the workers
+        '''
+        return (self.shm.name, self.shape, self.dtype.str)
+
+    @classmethod
+    def attach(cls, descriptor):
+        name, shape, dtype = descriptor
+        return cls(shape, dtype, _shm=shared_memory.SharedMemory(name=name))
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def pack_strings(strings):
+    '''Pack a list of strings into two shared arrays: the utf-8 encoded bytes
+       of all strings, and the offsets of each string in that buffer.
+
+    Returns:
+    (SharedArray, SharedArray) : buffer (uint8) and offsets (int64, len(strings)+1)
+    '''
+    encoded = [item.encode('utf-8') for item in strings]
+    offsets = SharedArray((len(encoded) + 1, ), np.int64)
+    offsets.array[0]  = 0
+    offsets.array[1:] = np.cumsum([len(item) for item in encoded], dtype=np.int64)
+    buffer  = SharedArray((int(offsets.array[-1]), ), np.uint8)
+    buffer.array[:] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return buffer, offsets
+
+
+def unpack_string(buffer, offsets, index):
+    '''Return string number index from arrays created by 'pack_strings'
+    '''
+    return bytes(buffer[offsets[index]: offsets[index+1]]).decode('utf-8')
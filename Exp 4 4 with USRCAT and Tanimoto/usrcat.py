@@ -0,0 +1,228 @@
+'''
+3D embedding and batched USRCAT scoring of molecules
+'''
+import math
+import time
+import hashlib
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from rdkit.Chem.rdMolDescriptors import GetUSRCAT
+from rdkit.Geometry import Point3D
+
+
+# Settings of the USRCAT Similarity calculation. Values given to 'initiate_ga' (usrcat_settings)
+# override these defaults.
+#   num_confs     : Number of conformers embedded per molecule (1: a single random conformer)
+#   prune_rms     : Conformers closer than this RMSD (Angstrom) to a kept conformer are discarded
+#   num_threads   : Threads used by RDKit to embed the conformers of one molecule (0: all cores)
+#   fusion        : How the scores of the conformers of a molecule are combined: 'max' or 'mean'
+#   ref_fusion    : How the scores against a panel of reference molecules are combined: 'max', 'mean', 
+#                   or 'top_k' (mean of the ref_top_k best scores)
+#   ref_top_k     : Number of best references averaged with ref_fusion='top_k'
+#   ref_num_confs : Number of conformers embedded for the reference molecule (see reference_set.py)
+#   embed_tiers   : Embedding strategies tried in turn, until one succeeds (see 'embedding_tiers')
+#   time_budget   : Wall-clock time (seconds) allowed for embedding a single molecule (all its conformers
+#                   and fragments), over all tiers. RDKit applies its timeout per conformer and per fragment,
+#                   in whole seconds, so the remaining budget is split between them, with at least 1 second
+#                   each. Not used in the deterministic mode (see seed)
+#   seed          : Run seed (int) of the deterministic mode: the embedding of each molecule is seeded with 
+#                   a hash of its canonical SMILES and this seed, and every tier is limited by a fixed number
+#                   of attempts instead of wall-clock time, so that its score is identical across workers, 
+#                   runs and machines. None: a different random embedding at every evaluation
+default_settings = {'num_confs':     1,
+                    'prune_rms':     0.5,
+                    'num_threads':   1,
+                    'fusion':        'max',
+                    'ref_fusion':    'max',
+                    'ref_top_k':     3,
+                    'ref_num_confs': 1,
+                    'embed_tiers':   ['etkdg', 'random_coords', 'relaxed', 'forcefield'],
+                    'time_budget':   10.0,
+                    'seed':          None,
+                   }
+
+# Ladder of embedding strategies, from the most to the least accurate:
+#   etkdg         : ETKDG (v3) distance geometry
+#   random_coords : ETKDG, starting from random coordinates instead of the eigenvalues of the distance matrix
+#   relaxed       : Random coordinates, without torsion preferences and with more iterations; smoothing 
+#                   failures of the bounds matrix are ignored
+#   forcefield    : 2D coordinates, lifted out of plane and relaxed with MMFF (UFF if MMFF parameters 
+#                   are missing); always gives a single conformer
+embedding_tiers = ['etkdg', 'random_coords', 'relaxed', 'forcefield']
+
+
+def get_settings(usrcat_settings=None):
+    '''Return default_settings, updated with the values in usrcat_settings
+    '''
+    settings = dict(default_settings)
+    if usrcat_settings is not None:
+        unknown = [key for key in usrcat_settings if key not in default_settings]
+        if len(unknown) > 0:
+            raise Exception('Unknown USRCAT settings: ', unknown)
+        settings.update(usrcat_settings)
+    if settings['fusion'] not in ('max', 'mean'):
+        raise Exception('Invalid choice of USRCAT fusion. Only possible choices are: max/mean')
+    if settings['ref_fusion'] not in ('max', 'mean', 'top_k'):
+        raise Exception('Invalid choice of reference fusion. Only possible choices are: max/mean/top_k')
+    if settings['ref_top_k'] < 1:
+        raise Exception('Invalid ref_top_k (must be at least 1): ', settings['ref_top_k'])
+    if len(settings['embed_tiers']) == 0 or any(tier not in embedding_tiers for tier in settings['embed_tiers']):
+        raise Exception('Invalid embedding tiers. Only possible choices are: ', embedding_tiers)
+    if settings['seed'] is not None and not isinstance(settings['seed'], int):
+        raise Exception('Invalid USRCAT seed (must be an int or None): ', settings['seed'])
+    return settings
+
+
+def embedding_seed(mol, run_seed):
+    '''Return the embedding seed of mol in deterministic mode: a hash of its canonical SMILES 
+       and run_seed, independent of the process and of PYTHONHASHSEED (-1 if run_seed is None)
+    '''
+    if run_seed is None:
+        return -1
+    key = '{} {}'.format(Chem.MolToSmiles(mol, isomericSmiles=True), run_seed).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=4).digest(), 'little') & 0x7fffffff
+
+
+def embed_conformers(mol, settings):
+    '''Embed conformers of mol in 3D, trying the strategies in settings['embed_tiers'] in turn.
+
+    All tiers together may use at most settings['time_budget'] seconds: a tier is not started
+    once the budget is spent, and distance geometry tiers are given the remaining time as 
+    their timeout (see 'embedding_parameters'). If settings['seed'] is set, all tiers are seeded 
+    (see 'embedding_seed') and tried until one succeeds, each limited by a fixed number of attempts 
+    per conformer, so that the result does not depend on the load or the speed of the machine.
+
+    Parameters:
+    mol      (rdkit.Chem.rdchem.Mol) : Molecule (without hydrogens)
+    settings (dict)                  : USRCAT settings (see 'default_settings')
+
+    Returns:
+    mol_3d   (rdkit.Chem.rdchem.Mol) : Copy of mol, with all embedded conformers (hydrogens removed)
+    conf_ids (list)                  : Ids of the conformers of mol_3d (empty if embedding failed)
+    tier     (int)                   : Index in 'embedding_tiers' of the successful strategy (-1 if none)
+    '''
+    start_time = time.time()
+    seed       = embedding_seed(mol, settings['seed'])
+    mol_3d     = Chem.AddHs(mol)
+    for tier in settings['embed_tiers']:
+        remaining = None
+        if settings['seed'] is None:
+            remaining = settings['time_budget'] - (time.time() - start_time)
+            if remaining <= 0:
+                break
+        mol_3d.RemoveAllConformers()
+        try:
+            if tier == 'forcefield':
+                embed_forcefield(mol_3d, seed)
+            else:
+                AllChem.EmbedMultipleConfs(mol_3d, settings['num_confs'], embedding_parameters(tier, settings, mol_3d, remaining, seed))
+        except (ValueError, RuntimeError):
+            continue
+        if mol_3d.GetNumConformers() > 0:
+            mol_3d = Chem.RemoveHs(mol_3d)
+            return mol_3d, [conf.GetId() for conf in mol_3d.GetConformers()], embedding_tiers.index(tier)
+    return Chem.RemoveHs(mol_3d), [], -1
+
+
+def embedding_parameters(tier, settings, mol_3d, remaining, seed=-1):
+    '''Return the RDKit EmbedParameters of a distance geometry tier (see 'embedding_tiers')
+
+    RDKit applies the timeout to every conformer of every fragment of mol_3d, so the remaining time
+    (seconds) is split between settings['num_confs'] conformers and the fragments. remaining=None 
+    (deterministic mode): no timeout, the tier is limited by its number of attempts per conformer only.
+    '''
+    params = AllChem.ETKDGv3()
+    params.randomSeed       = seed
+    params.enforceChirality = False
+    params.pruneRmsThresh   = settings['prune_rms']
+    params.numThreads       = settings['num_threads']
+    if remaining is None:
+        params.timeout       = 0
+        params.maxIterations = 10 * mol_3d.GetNumAtoms()
+    else:
+        num_parts      = settings['num_confs'] * len(Chem.GetMolFrags(mol_3d))
+        params.timeout = max(int(math.ceil(remaining / num_parts)), 1)
+    if tier in ('random_coords', 'relaxed'):
+        params.useRandomCoords = True
+    if tier == 'relaxed':
+        params.useExpTorsionAnglePrefs = False
+        params.useBasicKnowledge       = False
+        params.ignoreSmoothingFailures = True
+        params.maxIterations           = 50 * mol_3d.GetNumAtoms()
+    return params
+
+
+def embed_forcefield(mol_3d, seed=-1, max_iters=500):
+    '''Last resort embedding: 2D coordinates, randomly displaced out of plane, relaxed 
+       with a force field (MMFF, or UFF if MMFF parameters are missing)
+    '''
+    AllChem.Compute2DCoords(mol_3d)
+    conf = mol_3d.GetConformer()
+    conf.Set3D(True)
+    displacement = np.random.RandomState(seed if seed >= 0 else None).uniform(-0.5, 0.5, mol_3d.GetNumAtoms())
+    for idx in range(mol_3d.GetNumAtoms()):
+        pos = conf.GetAtomPosition(idx)
+        conf.SetAtomPosition(idx, Point3D(pos.x, pos.y, float(displacement[idx])))
+    if AllChem.MMFFHasAllMoleculeParams(mol_3d):
+        AllChem.MMFFOptimizeMolecule(mol_3d, maxIters=max_iters)
+    elif AllChem.UFFHasAllMoleculeParams(mol_3d):
+        AllChem.UFFOptimizeMolecule(mol_3d, maxIters=max_iters)
+
+
+def get_usrcat_descriptors(mol_3d, conf_ids):
+    '''Return the USRCAT descriptors of conformers conf_ids of mol_3d, shape (len(conf_ids), 60)
+    '''
+    return np.array([GetUSRCAT(mol_3d, confId=conf_id) for conf_id in conf_ids], dtype=np.float64).reshape((len(conf_ids), 60))
+
+
+def usrcat_score_matrix(descriptors, ref_descriptors):
+    '''USRCAT similarity between all pairs of descriptors, identical to rdMolDescriptors.GetUSRScore
+       (with the default weights of 1 for each of the 5 atom subsets)
+
+    Parameters:
+    descriptors     (np.array) : Shape (n, 60)
+    ref_descriptors (np.array) : Shape (m, 60)
+
+    Returns:
+    (np.array) : Shape (n, m), scores in (0, 1]
+    '''
+    diff = np.abs(descriptors[:, None, :] - ref_descriptors[None, :, :])
+    return 1.0 / (1.0 + diff.reshape((diff.shape[0], diff.shape[1], 5, 12)).mean(axis=3).sum(axis=2))
+
+
+def fuse_scores(scores, conf_ref, settings):
+    '''Combine a (molecule conformers, reference conformers) score matrix into a single score.
+
+    Each conformer of the molecule is matched to the most similar conformer of each reference;
+    the scores of the conformers of the molecule are combined per reference (settings['fusion']),
+    and the scores of all references are combined with settings['ref_fusion'] (see 'fuse_references').
+
+    Parameters:
+    scores   (np.array) : Shape (n, m), see 'usrcat_score_matrix'
+    conf_ref (np.array) : Shape (m, ), index of the reference of each reference conformer (sorted)
+    settings (dict)     : USRCAT settings (see 'default_settings')
+
+    Returns:
+    (float) : Similarity score
+    '''
+    starts = np.flatnonzero(np.r_[True, conf_ref[1:] != conf_ref[:-1]])    # first conformer of each reference
+    best   = np.maximum.reduceat(scores, starts, axis=1)                   # (n, num. references)
+    if settings['fusion'] == 'max':
+        per_ref = best.max(axis=0)
+    else:
+        per_ref = best.mean(axis=0)
+    return float(fuse_references(per_ref[:, None], settings)[0])
+
+
+def fuse_references(scores, settings):
+    '''Combine the scores of molecules against a panel of references, shape (num. references, num. molecules),
+       into one score per molecule: 'max', 'mean', or 'top_k' (mean of the settings['ref_top_k'] best references)
+    '''
+    scores = np.asarray(scores, dtype=np.float64)
+    if settings['ref_fusion'] == 'max':
+        return scores.max(axis=0)
+    if settings['ref_fusion'] == 'mean':
+        return scores.mean(axis=0)
+    k = min(settings['ref_top_k'], scores.shape[0])
+    return np.partition(scores, scores.shape[0] - k, axis=0)[scores.shape[0] - k:].mean(axis=0)
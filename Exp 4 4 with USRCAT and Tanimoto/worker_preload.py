@@ -0,0 +1,8 @@
+'''
+Imported by the fork server of the worker pool (see generation_props.create_worker_pool), 
+so that the static resources of the property calculations are loaded once, in the server, 
+and shared copy-on-write by all workers it forks.
+'''
+import generation_props
+
+generation_props.preload_static_resources()